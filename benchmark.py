@@ -0,0 +1,353 @@
+"""Offline benchmark for ratp_status against a local PRIM stand-in.
+
+Example:
+    python benchmark.py --disruptions 800 --latency 0.05 --save-baseline bench.json
+    python benchmark.py --disruptions 800 --latency 0.05 --compare bench.json --threshold 0.2
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+import resource
+from threading import Thread, local
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import requests
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+import ratp_status
+
+STAGES = ("discovery", "upstream", "normalize", "snapshot", "history", "archive", "http")
+HTTP_ROUTES = (
+    "/",
+    "/status.json",
+    "/status_normalized.json",
+    "/status_normalized.json?since={version}",
+    "/status_normalized.json?network=metro&line=4",
+    "/health",
+    "/history.json",
+    "/metrics",
+)
+SEVERITIES = ("BLOQUANTE", "CRITIQUE", "MAJEURE", "MINEURE", "PERTURBEE", "INFO")
+CAUSES = ("TRAVAUX", "PERTURBATION", "INFORMATION", "GREVE")
+
+
+# --- Synthetic payloads ---
+def synthetic_lines():
+    lines = [{"id": f"line:IDFM:M{n}", "name": str(n), "mode": "Metro"} for n in range(1, 15)]
+    lines += [{"id": f"line:IDFM:R{c}", "name": c, "mode": "RapidTransit"} for c in "ABCDE"]
+    lines += [{"id": f"line:IDFM:T{n}", "name": f"T{n}", "mode": "Tramway"} for n in range(1, 14)]
+    lines += [{"id": f"line:IDFM:B{n}", "name": str(n), "mode": "Bus"} for n in range(20, 400)]
+    return lines
+
+
+def synthetic_bulk(n_disruptions, lines_per, seed=0, churn=0.0):
+    """disruptions_bulk v2 payload; ``churn`` is the share of disruption ids that change with ``seed``."""
+    rnd = random.Random(1234)
+    lines = synthetic_lines()
+    disruptions = []
+    for i in range(n_disruptions):
+        did = f"d-{seed}-{i}" if i < churn * n_disruptions else f"d-{i}"
+        disruptions.append({
+            "id": did,
+            "title": f"<p>Trafic perturbé sur la ligne &amp; gares desservies — incident n°{i}</p>",
+            "message": "Circulation interrompue entre deux gares en raison d'un incident technique. " * 3,
+            "severity": rnd.choice(SEVERITIES),
+            "cause": rnd.choice(CAUSES),
+            "lastUpdate": f"20260101T{i % 24:02d}0000",
+            "impacted_objects": [{"pt_object": {"id": l["id"]}} for l in rnd.sample(lines, lines_per)],
+        })
+    return {"disruptions": disruptions, "lines": lines, "lastUpdatedDate": f"seed-{seed}"}
+
+
+def synthetic_siri(n_messages, lines_per, seed=0, churn=0.0):
+    rnd = random.Random(1234)
+    lines = synthetic_lines()
+    messages = []
+    for i in range(n_messages):
+        text = f"Message {seed if i < churn * n_messages else 0}-{i}: trafic perturbé."
+        messages.append({"Content": {
+            "Message": [{"MessageText": {"value": text}}],
+            "AffectedLine": [{"LineRef": {"value": l["id"]}} for l in rnd.sample(lines, lines_per)],
+        }})
+    return {"Siri": {"ServiceDelivery": {"GeneralMessageDelivery": [{"InfoMessage": messages}]}}}
+
+
+# --- Fake PRIM server ---
+class FakePrimHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _serve(self):
+        srv = self.server
+        # Drain the request body, otherwise it is read as the start of the next request on a kept-alive connection.
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if srv.latency:
+            time.sleep(srv.latency)
+        path = urlsplit(self.path).path
+        # Only one endpoint variant answers, so that discovery has to walk past failing ones.
+        if srv.accept_path not in path:
+            return self._reply(404, b'{"error":"not found"}')
+        if self.command != "GET" or not self.headers.get("Authorization", "").startswith("Apikey "):
+            return self._reply(401, b'{"error":"unauthorized"}')
+        if srv.etag and self.headers.get("If-None-Match") == srv.etag:
+            return self._reply(304, b"")
+        self._reply(200, srv.payload)
+
+    def _reply(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if status == 200 and self.server.etag:
+            self.send_header("ETag", self.server.etag)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.hits += 1
+
+    do_GET = _serve
+    do_POST = _serve
+
+    def log_message(self, *args):
+        pass
+
+
+def start_fake_prim(payload, latency=0.0, accept_path="/disruptions-bulk/", etag=False):
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), FakePrimHandler)
+    srv.daemon_threads = True
+    srv.latency = latency
+    srv.accept_path = accept_path
+    srv.hits = 0
+    srv.etag = None
+    set_fake_payload(srv, payload, etag)
+    Thread(target=srv.serve_forever, daemon=True).start()
+    return srv
+
+
+def set_fake_payload(srv, payload, etag=False):
+    srv.payload = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    srv.etag = f'"{hash(srv.payload) & 0xffffffff:x}"' if etag else None
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+# --- Measurement ---
+def summarize(samples, peak=None, wall=None):
+    ordered = sorted(samples)
+    n = len(ordered)
+
+    def pct(p):
+        return ordered[min(n - 1, int(round(p / 100 * (n - 1))))] * 1000 if n else None
+
+    result = {
+        "n": n,
+        "mean_ms": sum(ordered) / n * 1000 if n else None,
+        "p50_ms": pct(50),
+        "p90_ms": pct(90),
+        "p99_ms": pct(99),
+        "ops_per_s": n / (wall if wall else sum(ordered)) if n and (wall or sum(ordered)) else None,
+    }
+    if peak is not None:
+        result["peak_kib"] = peak / 1024
+    return result
+
+
+def measure(fn, iterations):
+    """Time ``fn(i)`` over ``iterations`` runs, then one extra traced run for peak allocated memory."""
+    samples = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        fn(i)
+        samples.append(time.perf_counter() - start)
+    tracemalloc.start()
+    fn(iterations)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return summarize(samples, peak)
+
+
+def load_http(base_url, path, concurrency, total):
+    tls = local()
+
+    def one(_):
+        session = getattr(tls, "session", None)
+        if session is None:
+            session = tls.session = requests.Session()
+        start = time.perf_counter()
+        resp = session.get(base_url + path, headers={"Accept-Encoding": "gzip"})
+        resp.content
+        if resp.status_code >= 400:
+            raise RuntimeError(f"{path}: HTTP {resp.status_code}")
+        return time.perf_counter() - start
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        samples = list(pool.map(one, range(total)))
+    return summarize(samples, wall=time.perf_counter() - started)
+
+
+def isolate(workdir, api_url):
+    """Point every ratp_status path and the upstream URL at a scratch directory and the fake server."""
+    rs = ratp_status
+    rs.REPO_PATH = workdir
+    data = os.path.join(workdir, "data")
+    rs.HISTORY_PATH = os.path.join(data, "history.json")
+    rs.HISTORY_LOG_PATH = os.path.join(data, "history.log.jsonl")
+    rs.HISTORY_DB_PATH = os.path.join(data, "history.sqlite")
+    rs.ENDPOINT_CACHE_PATH = os.path.join(data, "endpoint.json")
+    rs.SHARED_SNAPSHOT_PATH = os.path.join(data, "snapshot.bin")
+    rs.SHARED_STATE_PATH = os.path.join(data, "snapshot.state.json")
+    rs.SHARED_METRICS_PATH = os.path.join(data, "metrics.poller.json")
+    rs.POLLER_LOCK_PATH = os.path.join(data, "poller.lock")
+    rs.REINDEX_CHECKPOINT_PATH = os.path.join(data, "reindex.json")
+    rs.ARCHIVE_MAINTENANCE_PATH = os.path.join(data, "maintenance.json")
+    rs.API_KEY = "bench"
+    # Keep the fallback variants but never let the benchmark reach the real PRIM host.
+    origin = api_url.split("/marketplace/")[0]
+    rs.API_URL_CANDIDATES = [u for u in rs._build_api_url_candidates(api_url) if u.startswith(origin)]
+
+
+def reset_endpoint():
+    ratp_status.endpoint_state.update({"loaded": True, "variant": None, "failures": 0, "next_discovery": 0,
+                                       "backoff": ratp_status.CACHE_DURATION})
+    ratp_status.upstream_validators.update({"variant": None, "etag": None, "last_modified": None, "hash": None})
+
+
+def run(args):
+    make = synthetic_siri if args.format == "siri" else synthetic_bulk
+    if args.payload:
+        with open(args.payload, "r", encoding="utf-8") as f:
+            base_payload = json.load(f)
+        # A per-iteration marker keeps successive snapshots distinct, like live data would be.
+        payloads = lambda i: dict(base_payload, benchmarkSeed=i) if isinstance(base_payload, dict) else base_payload  # noqa: E731
+    else:
+        payloads = lambda i: make(args.disruptions, args.lines_per, seed=i, churn=args.churn)  # noqa: E731
+    stages = STAGES if args.stages == "all" else tuple(s.strip() for s in args.stages.split(","))
+    results = {}
+
+    srv = start_fake_prim(payloads(0), latency=args.latency, etag=args.etag)
+    api_url = f"http://127.0.0.1:{srv.server_address[1]}/marketplace/disruptions_bulk/disruptions/v2"
+    workdir = tempfile.mkdtemp(prefix="ratp-bench-")
+    isolate(workdir, api_url)
+    raw = srv.payload
+    print(f"Payload: {len(raw) / 1024:.0f} KiB, {len(ratp_status.API_URL_CANDIDATES)} candidate URLs, workdir {workdir}")
+
+    if "discovery" in stages:
+        def discovery(_):
+            reset_endpoint()
+            if ratp_status.get_api_data() is None:
+                raise RuntimeError("discovery failed: " + str(ratp_status.api_diag.get("last_error")))
+        results["discovery"] = measure(discovery, max(1, args.iterations // 5))
+    if "upstream" in stages:
+        def upstream(_):
+            if ratp_status.get_api_data() is None:
+                raise RuntimeError("upstream fetch failed: " + str(ratp_status.api_diag.get("last_error")))
+        reset_endpoint()
+        upstream(0)
+        ratp_status.commit_validators(True)  # as after an installed snapshot, so --etag exercises conditional requests
+        results["upstream"] = measure(upstream, args.iterations)
+    bodies = [json.dumps(payloads(i), ensure_ascii=False).encode("utf-8") for i in range(args.iterations + 1)]
+    if "normalize" in stages:
+        results["normalize"] = measure(lambda i: ratp_status.normalize_raw(bodies[i]), args.iterations)
+    if "snapshot" in stages:
+        results["snapshot"] = measure(lambda i: ratp_status.build_snapshot(bodies[i], time.time(), i + 1), args.iterations)
+    if "history" in stages:
+        normalized = [ratp_status.build_snapshot(b, time.time(), i + 1)["normalized"] for i, b in enumerate(bodies)]
+        results["history"] = measure(lambda i: ratp_status.update_history(normalized[i]), args.iterations)
+    if "archive" in stages:
+        ratp_status.ensure_git_repo(workdir)
+        results["archive"] = measure(lambda i: ratp_status._archive_snapshot(time.time(), bodies[i], None), args.iterations)
+        start = time.perf_counter()
+        if ratp_status.archive_state["pending_paths"]:
+            ratp_status._commit_archive()
+        results["archive_commit"] = summarize([time.perf_counter() - start])
+    if "http" in stages:
+        reset_endpoint()
+        for i in range(2):
+            # Two snapshots, so that ?since= benchmarks a real delta rather than the full-body fallback.
+            set_fake_payload(srv, payloads(i), args.etag)
+            if not ratp_status.refresh_cache():
+                raise RuntimeError("refresh failed: " + str(ratp_status.refresher_state["last_error"]))
+        version = ratp_status.data_cache["version"]
+        server = make_server("127.0.0.1", 0, ratp_status.app, threaded=True,
+                             request_handler=QuietRequestHandler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_port}"
+        for route in HTTP_ROUTES:
+            path = route.format(version=version - 1)
+            results[f"http {path}"] = load_http(base_url, path, args.concurrency, args.requests)
+        server.shutdown()
+
+    results["_process"] = {"max_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, "upstream_hits": srv.hits}
+    srv.shutdown()
+    return results
+
+
+def print_results(results, baseline=None):
+    print(f"{'stage':<52}{'n':>6}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'ops/s':>10}{'peak KiB':>10}{'vs base':>9}")
+    for name, r in results.items():
+        if name.startswith("_"):
+            continue
+        delta = ""
+        if baseline and name in baseline and baseline[name].get("p50_ms"):
+            delta = f"{(r['p50_ms'] / baseline[name]['p50_ms'] - 1) * 100:+.0f}%"
+        fmt = lambda v: f"{v:.2f}" if isinstance(v, float) else "-"  # noqa: E731
+        print(f"{name:<52}{r['n']:>6}{fmt(r['p50_ms']):>10}{fmt(r['p90_ms']):>10}{fmt(r['p99_ms']):>10}"
+              f"{fmt(r['ops_per_s']):>10}{fmt(r.get('peak_kib')):>10}{delta:>9}")
+    print(f"max RSS: {results['_process']['max_rss_kib'] / 1024:.1f} MiB, upstream hits: {results['_process']['upstream_hits']}")
+
+
+def regressions(results, baseline, threshold):
+    """Stages whose median latency grew by more than ``threshold`` (a fraction) against the baseline."""
+    found = []
+    for name, r in results.items():
+        base = baseline.get(name)
+        if name.startswith("_") or not base or not base.get("p50_ms") or r.get("p50_ms") is None:
+            continue
+        ratio = r["p50_ms"] / base["p50_ms"] - 1
+        if ratio > threshold:
+            found.append(f"{name}: p50 {base['p50_ms']:.2f} -> {r['p50_ms']:.2f} ms ({ratio * 100:+.0f}%)")
+    return found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ratp_status benchmark against a local PRIM stand-in")
+    parser.add_argument("--format", choices=("bulk", "siri"), default="bulk", help="Synthetic payload format.")
+    parser.add_argument("--payload", type=str, help="Recorded upstream payload (JSON file) instead of synthetic data.")
+    parser.add_argument("--disruptions", type=int, default=400, help="Synthetic disruptions (or Siri messages).")
+    parser.add_argument("--lines-per", type=int, default=3, help="Affected lines per synthetic disruption.")
+    parser.add_argument("--churn", type=float, default=0.1, help="Share of disruptions replaced between snapshots.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Fake PRIM response latency in seconds.")
+    parser.add_argument("--etag", action="store_true", help="Make the fake PRIM server answer conditional requests.")
+    parser.add_argument("--iterations", type=int, default=20, help="Iterations per in-process stage.")
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent HTTP clients.")
+    parser.add_argument("--requests", type=int, default=400, help="HTTP requests per route.")
+    parser.add_argument("--stages", type=str, default="all", help=f"Comma-separated subset of {','.join(STAGES)}.")
+    parser.add_argument("--json-out", type=str, help="Write results as JSON.")
+    parser.add_argument("--save-baseline", type=str, help="Write results to this baseline file.")
+    parser.add_argument("--compare", type=str, help="Baseline file to compare against; exits 1 on regression.")
+    parser.add_argument("--threshold", type=float, default=0.25, help="Allowed p50 slowdown vs baseline (fraction).")
+    args = parser.parse_args()
+
+    results = run(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    for path in (args.json_out, args.save_baseline):
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(results, f, indent=2)
+    if baseline is not None:
+        found = regressions(results, baseline, args.threshold)
+        for line in found:
+            print(f"REGRESSION {line}")
+        sys.exit(1 if found else 0)
@@ -1,16 +1,53 @@
 import os
+import io
 import json
 import time
 import argparse
+import bisect
+import shutil
+import random
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import re
+import sys
+import cProfile
+import unicodedata
+from functools import lru_cache
+from contextlib import contextmanager
+import mmap
+import queue
+import sqlite3
+import gzip
+import hashlib
 from html import unescape
-from datetime import datetime, timezone
-from threading import Thread, Lock
+from datetime import datetime, timedelta, timezone
+from threading import Thread, Lock, Event
 
 import requests
-from flask import Flask, jsonify, render_template_string
+from requests.adapters import HTTPAdapter
+from flask import Flask, Response, g, jsonify, request
 from git import Repo, Actor
 
+try:
+    import brotli
+except ImportError:  # optional: only used to pre-compress responses
+    brotli = None
+
+try:
+    import fcntl
+except ImportError:  # non-POSIX: every process polls upstream on its own
+    fcntl = None
+
+try:
+    import ijson
+except ImportError:  # optional: streaming normalization of disruptions_bulk payloads
+    ijson = None
+
+try:
+    import zstandard
+except ImportError:  # optional: archive segments fall back to gzip
+    zstandard = None
+
 # --- Configuration ---
 API_KEY = os.getenv("IDFM_API_KEY", "oyTLFQfbTUuF4smBI4bHq9v07r42EPrI")
 API_URL_BASE = os.getenv(
@@ -52,120 +89,636 @@ def _build_api_url_candidates(base: str):
 
 
 API_URL_CANDIDATES = _build_api_url_candidates(API_URL_BASE)
-CACHE_DURATION = 15  # seconds
+CACHE_DURATION = int(os.getenv("IDFM_CACHE_SOFT_TTL", "15"))  # fastest polling interval (seconds), used while upstream data keeps changing
+CACHE_HARD_TTL = int(os.getenv("IDFM_CACHE_HARD_TTL", "3600"))  # seconds a snapshot may be served while upstream fails
+CACHE_COLD_WAIT = 30  # seconds a reader waits for the very first snapshot
+POLL_MAX_INTERVAL = int(os.getenv("IDFM_POLL_MAX_INTERVAL", "120"))  # slowest cadence once upstream data stops changing
+POLL_DAILY_QUOTA = int(os.getenv("IDFM_DAILY_QUOTA", "0"))  # upstream polls allowed per UTC day; 0 disables the budget
+POLL_ERROR_BACKOFF_MAX = int(os.getenv("IDFM_POLL_ERROR_BACKOFF_MAX", "600"))  # seconds
+POLL_CHANGE_ALPHA = 0.2  # weight of the latest poll in the change-rate average
+POLL_GROWTH = 0.5  # interval growth per unchanged poll when nothing changed recently
+DELTA_HISTORY = int(os.getenv("IDFM_DELTA_HISTORY", "40"))  # snapshot versions kept for ?since= deltas
+SSE_HEARTBEAT = int(os.getenv("IDFM_SSE_HEARTBEAT", "20"))  # seconds between keep-alive comments on /events
+SSE_QUEUE_SIZE = int(os.getenv("IDFM_SSE_QUEUE_SIZE", "8"))  # pending events per client before it is dropped
+SSE_MAX_CLIENTS = int(os.getenv("IDFM_SSE_MAX_CLIENTS", "8"))  # /events connections per worker; beyond, clients poll ?since=
 REPO_PATH = "."
 HISTORY_PATH = os.path.join(REPO_PATH, "data", "history.json")
+HISTORY_LOG_PATH = os.path.join(REPO_PATH, "data", "history.log.jsonl")
+HISTORY_PER_LINE = int(os.getenv("IDFM_HISTORY_PER_LINE", "100"))
+HISTORY_COMPACT_AFTER = int(os.getenv("IDFM_HISTORY_COMPACT_AFTER", "500"))  # log records before history.json is rewritten
+HISTORY_DB_PATH = os.path.join(REPO_PATH, "data", "history.sqlite")
+HISTORY_DB_GAP = int(os.getenv("IDFM_HISTORY_DB_GAP", "300"))  # seconds an item may vanish and still extend the same occurrence
+HISTORY_QUERY_MAX = 1000  # page size cap for /history/query
+HISTORY_DB_READERS = 4  # idle read connections kept for /history/query and /history/aggregate
+REINDEX_GAP = 1800  # unchanged snapshots are not archived, so archived neighbours may be further apart than live ones
+REINDEX_CHECKPOINT_PATH = os.path.join(REPO_PATH, "data", "reindex.json")
+ARCHIVE_COMMIT_INTERVAL = int(os.getenv("IDFM_ARCHIVE_COMMIT_INTERVAL", "600"))  # seconds between batched commits
+ARCHIVE_QUEUE_SIZE = 64
+ARCHIVE_PUSH_BACKOFF_MAX = 3600  # seconds
+ARCHIVE_PACK_BLOCK = 32  # snapshots per independently compressed block of a packed day
+ARCHIVE_FULL_DAYS = int(os.getenv("IDFM_ARCHIVE_FULL_DAYS", "30"))  # days kept at full resolution once packed
+ARCHIVE_SAMPLE_INTERVAL = int(os.getenv("IDFM_ARCHIVE_SAMPLE_INTERVAL", "3600"))  # seconds between snapshots kept after that
+ARCHIVE_MAX_DAYS = int(os.getenv("IDFM_ARCHIVE_MAX_DAYS", "0"))  # days kept at all; 0 keeps everything
+ARCHIVE_MAINTENANCE_PATH = os.path.join(REPO_PATH, "data", "maintenance.json")
+CONTENT_ADDRESSED_KEYS = ("disruptions", "lines")  # payload lists stored as shared objects in archive segments
+SHARED_SNAPSHOT_PATH = os.path.join(REPO_PATH, "data", "snapshot.bin")
+SHARED_STATE_PATH = os.path.join(REPO_PATH, "data", "snapshot.state.json")  # freshness, rewritten on every poll
+SHARED_METRICS_PATH = os.path.join(REPO_PATH, "data", "metrics.poller.json")  # poller-only series, for followers' /metrics
+POLLER_LOCK_PATH = os.path.join(REPO_PATH, "data", "poller.lock")
+SHARED_POLL_INTERVAL = 0.5  # seconds between follower checks of the shared snapshot
 
 # --- Globals ---
 app = Flask(__name__)
-data_cache = {"timestamp": 0, "data": None}
-cache_lock = Lock()
+# The refresher replaces data_cache wholesale, so readers can take a reference without locking.
+data_cache = {"timestamp": 0, "checked": 0, "raw": None}
+cache_lock = Lock()  # serializes upstream refreshes; readers never take it
+refresher_state = {"thread": None, "last_attempt": None, "last_error": None}
+# Polling schedule: the interval stays at CACHE_DURATION while upstream data changes and stretches when it does not.
+poll_state = {"interval": CACHE_DURATION, "delay": CACHE_DURATION, "next_run": None, "change_rate": 1.0, "errors": 0, "quota_day": None, "calls": 0}
+serving_state = {"role": None, "lock_file": None, "stamp": None}  # role: "poller" | "follower" once serving
+refresher_lock = Lock()
+serving_lock = Lock()
+snapshot_ready = Event()
+recent_items = OrderedDict()  # snapshot version -> {item key: item}, for ?since= deltas
+sse_clients = set()  # one bounded queue per connected /events client
+sse_lock = Lock()
 
 # Diagnostics
-api_diag = {"last_url": None, "last_method": None, "last_headers": None, "last_status": None, "last_error": None, "ok": False}
+api_diag = {"last_url": None, "last_method": None, "last_headers": None, "last_status": None, "last_error": None, "ok": False,
+            "negotiated": None, "failed_variants": [], "endpoint_failures": 0, "next_discovery": None,
+            "unchanged": False}
+# Served live on /health; snapshot meta only keeps the first seven, the variant list would bloat every payload.
+API_DIAG_KEYS = ("ok", "last_url", "last_method", "last_headers", "last_status", "last_error", "negotiated",
+                 "failed_variants", "endpoint_failures", "next_discovery")
+
+# Metrics: Prometheus text exposition served on /metrics, kept in-process without extra dependencies.
+METRIC_HELP = {
+    "idfm_upstream_requests_total": ("counter", "Upstream PRIM requests by phase (poll, discovery), method and HTTP status."),
+    "idfm_upstream_request_seconds": ("histogram", "Upstream PRIM request latency by phase (poll, discovery)."),
+    "idfm_cache_requests_total": ("counter", "Snapshot reads by result (hit, stale, miss)."),
+    "idfm_cache_age_seconds": ("gauge", "Age of the snapshot being served."),
+    "idfm_snapshot_version": ("gauge", "Version of the snapshot being served."),
+    "idfm_snapshot_items": ("gauge", "Normalized items in the current snapshot."),
+    "idfm_normalize_seconds": ("histogram", "Time to normalize and serialize one upstream snapshot."),
+    "idfm_history_update_seconds": ("histogram", "Time to merge one snapshot into the per-line history."),
+    "idfm_history_save_seconds": ("histogram", "Time to compact history.json."),
+    "idfm_history_index_seconds": ("histogram", "Time to update the SQLite history index."),
+    "idfm_archive_write_seconds": ("histogram", "Time to append one snapshot to its archive segment."),
+    "idfm_archive_commit_seconds": ("histogram", "Time to commit pending archive segments."),
+    "idfm_archive_push_seconds": ("histogram", "Time to push archive commits."),
+    "idfm_archive_queue": ("gauge", "Snapshots waiting for the archiver."),
+    "idfm_sse_clients": ("gauge", "Connected /events clients."),
+    "idfm_poll_interval_seconds": ("gauge", "Current upstream polling interval."),
+    "idfm_poll_next_run_timestamp": ("gauge", "Unix time of the next scheduled upstream poll."),
+    "idfm_poll_change_rate": ("gauge", "Moving share of polls that returned new upstream data."),
+    "idfm_http_request_seconds": ("histogram", "HTTP request latency by route and status."),
+    "idfm_http_response_bytes": ("histogram", "HTTP response body size by route."),
+}
+# Series every worker records for itself; all others are only recorded by the poller and followers serve the copy it
+# publishes. Every series carries a worker="<pid>" label; aggregate across workers with e.g.
+# sum without (worker) (rate(idfm_http_request_seconds_count[5m])).
+WORKER_METRICS = {"idfm_cache_requests_total", "idfm_cache_age_seconds", "idfm_snapshot_version", "idfm_sse_clients",
+                  "idfm_http_request_seconds", "idfm_http_response_bytes"}
+METRIC_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+PROFILE_STAGES = {s.strip() for s in os.getenv("IDFM_PROFILE_STAGES", "").split(",") if s.strip()}
+metrics = {"values": {}, "histograms": {}}
+metrics_lock = Lock()
+stage_hooks = []  # callables (stage, seconds, labels) run after every timed() stage
+
+
+def _metric_key(name, labels):
+    return name, tuple(sorted((labels or {}).items()))
+
+
+def metric_inc(name, labels=None, value=1):
+    key = _metric_key(name, labels)
+    with metrics_lock:
+        metrics["values"][key] = metrics["values"].get(key, 0) + value
+
+
+def metric_set(name, value, labels=None):
+    with metrics_lock:
+        metrics["values"][_metric_key(name, labels)] = value
+
+
+def metric_observe(name, value, labels=None, buckets=METRIC_BUCKETS):
+    key = _metric_key(name, labels)
+    with metrics_lock:
+        hist = metrics["histograms"].get(key)
+        if hist is None:
+            hist = metrics["histograms"][key] = {"buckets": buckets, "counts": [0] * len(buckets), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(hist["buckets"]):
+            if value <= bound:
+                hist["counts"][i] += 1
+        hist["sum"] += value
+        hist["count"] += 1
+
+
+@contextmanager
+def timed(stage, **labels):
+    """Observe the duration of ``stage`` as idfm_<stage>_seconds; profiles it when listed in IDFM_PROFILE_STAGES."""
+    profiler = None
+    if stage in PROFILE_STAGES:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        if profiler is not None:
+            profiler.disable()
+            try:
+                os.makedirs(os.path.join(REPO_PATH, "data", "profile"), exist_ok=True)
+                profiler.dump_stats(os.path.join(REPO_PATH, "data", "profile", f"{stage}.prof"))
+            except Exception as e:
+                print(f"Warning: could not write profile for {stage}: {e}")
+        metric_observe(f"idfm_{stage}_seconds", elapsed, labels)
+        for hook in stage_hooks:
+            try:
+                hook(stage, elapsed, labels)
+            except Exception as e:
+                print(f"Warning: stage hook failed: {e}")
+
+
+def _format_labels(labels, extra=None):
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def _metrics_copy(worker, names=None):
+    """(values, histograms) recorded in this process, keyed with a worker label; ``names`` filters by predicate."""
+    worker_label = ("worker", str(worker))
+    with metrics_lock:
+        values = {(m, (worker_label,) + labels): v for (m, labels), v in metrics["values"].items()
+                  if names is None or names(m)}
+        histograms = {(m, (worker_label,) + labels): dict(h, counts=list(h["counts"]))
+                      for (m, labels), h in metrics["histograms"].items() if names is None or names(m)}
+    return values, histograms
+
+
+def publish_metrics():
+    """Atomically write the poller-only series for followers (poller only)."""
+    if serving_state["role"] != "poller":
+        return
+    values, histograms = _metrics_copy(os.getpid(), lambda m: m not in WORKER_METRICS)
+    doc = {"values": [[m, labels, v] for (m, labels), v in values.items()],
+           "histograms": [[m, labels, h] for (m, labels), h in histograms.items()]}
+    try:
+        tmp = f"{SHARED_METRICS_PATH}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(doc, f, separators=(",", ":"))
+        os.replace(tmp, SHARED_METRICS_PATH)
+    except Exception as e:
+        print(f"Warning: could not publish metrics: {e}")
+
+
+def _poller_metrics():
+    try:
+        with open(SHARED_METRICS_PATH, "r", encoding="utf-8") as f:
+            doc = json.load(f)
+    except (OSError, ValueError):
+        return {}, {}
+    values = {(m, tuple(map(tuple, labels))): v for m, labels, v in doc["values"]}
+    histograms = {(m, tuple(map(tuple, labels))): h for m, labels, h in doc["histograms"]}
+    return values, histograms
+
+
+def render_metrics():
+    """Prometheus text exposition format (version 0.0.4).
+
+    Followers add the poller's published series, so any worker answers with the upstream, normalization, history
+    and archive series.
+    """
+    if serving_state["role"] == "follower":
+        values, histograms = _metrics_copy(os.getpid(), lambda m: m in WORKER_METRICS)
+        poller_values, poller_histograms = _poller_metrics()
+        values.update(poller_values)
+        histograms.update(poller_histograms)
+    else:
+        values, histograms = _metrics_copy(os.getpid())
+    by_name = {}
+    for (metric, labels), value in values.items():
+        by_name.setdefault(metric, ([], []))[0].append((labels, value))
+    for (metric, labels), hist in histograms.items():
+        by_name.setdefault(metric, ([], []))[1].append((labels, hist))
+    out = []
+    for name, (kind, help_text) in METRIC_HELP.items():
+        out.append(f"# HELP {name} {help_text}")
+        out.append(f"# TYPE {name} {kind}")
+        series, hists = by_name.get(name, ((), ()))
+        for labels, value in sorted(series, key=lambda s: s[0]):
+            out.append(f"{name}{_format_labels(labels)} {value}")
+        for labels, hist in sorted(hists, key=lambda s: s[0]):
+            for bound, count in zip(hist["buckets"], hist["counts"]):
+                out.append(f"{name}_bucket{_format_labels(labels, ('le', bound))} {count}")
+            out.append(f"{name}_bucket{_format_labels(labels, ('le', '+Inf'))} {hist['count']}")
+            out.append(f"{name}_sum{_format_labels(labels)} {hist['sum']}")
+            out.append(f"{name}_count{_format_labels(labels)} {hist['count']}")
+    return "\n".join(out) + "\n"
+
+
+# Negotiated endpoint: the (url, auth placement, header, method) combination that last returned
+# valid JSON. It is persisted so that restarts skip the discovery walk.
+ENDPOINT_CACHE_PATH = os.path.join(REPO_PATH, "data", "endpoint.json")
+ENDPOINT_MAX_FAILURES = int(os.getenv("IDFM_ENDPOINT_MAX_FAILURES", "3"))
+ENDPOINT_BACKOFF_MAX = int(os.getenv("IDFM_ENDPOINT_BACKOFF_MAX", "900"))  # seconds
+API_AUTH_PARAMS = (None, "apiKey", "apikey", "key")
+API_AUTH_HEADERS = ("apikey", "apiKey", "X-API-KEY", "Authorization")
+API_METHODS = ("GET", "POST")
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("IDFM_CONNECT_TIMEOUT", "5"))  # seconds
+UPSTREAM_READ_TIMEOUT = float(os.getenv("IDFM_READ_TIMEOUT", "20"))  # seconds
+UPSTREAM_PROBE_CONCURRENCY = int(os.getenv("IDFM_PROBE_CONCURRENCY", "16"))  # variants raced in parallel during discovery
+upstream = {"session": None}
+upstream_lock = Lock()
+# Validators of the last payload from the negotiated endpoint, used to detect unchanged upstream data.
+upstream_validators = {"variant": None, "etag": None, "last_modified": None, "hash": None}
+# Validators of the last body returned by get_api_data(); only trusted once that body became a snapshot.
+pending_validators = {"variant": None, "validators": None}
+NOT_MODIFIED = object()  # returned by get_api_data() when upstream data is unchanged
+endpoint_state = {"loaded": False, "variant": None, "failures": 0, "next_discovery": 0, "backoff": CACHE_DURATION}
+
+
+def _api_variants():
+    """Yield every (url, auth param, auth header, method) combination in discovery order."""
+    params = API_AUTH_PARAMS if API_KEY else (None,)
+    for url in API_URL_CANDIDATES:
+        for param in params:
+            for header in API_AUTH_HEADERS:
+                for method in API_METHODS:
+                    yield {"url": url, "param": param, "header": header, "method": method}
+
+
+def _variant_label(variant):
+    return f"{variant['method']} {variant['url']} param={variant['param']} header={variant['header']}"
+
+
+def _variant_request(variant):
+    target_url = variant["url"]
+    if variant["param"] and API_KEY:
+        target_url += ("&" if "?" in target_url else "?") + f"{variant['param']}={API_KEY}"
+    header = variant["header"]
+    headers = {header: f"Apikey {API_KEY}" if header == "Authorization" else API_KEY, "Accept": "application/json"}
+    return target_url, headers
+
+
+def upstream_session():
+    """Shared keep-alive session for every PRIM request."""
+    with upstream_lock:
+        if upstream["session"] is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=8, pool_maxsize=max(UPSTREAM_PROBE_CONCURRENCY, 1))
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers["Accept-Encoding"] = "gzip, deflate"
+            upstream["session"] = session
+        return upstream["session"]
+
+
+def _try_variant(variant, conditional=False):
+    """Issue a single request for ``variant``. Returns (data, error, validators).
+
+    With ``conditional``, the stored validators are sent and ``data`` is NOT_MODIFIED when upstream
+    answers 304 or returns a body identical to the previous one.
+    """
+    target_url, headers = _variant_request(variant)
+    method = variant["method"]
+    known = conditional and upstream_validators["variant"] == _variant_label(variant)
+    if known and upstream_validators["etag"]:
+        headers["If-None-Match"] = upstream_validators["etag"]
+    if known and upstream_validators["last_modified"]:
+        headers["If-Modified-Since"] = upstream_validators["last_modified"]
+    session = upstream_session()
+    timeout = (UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT)
+    # Bounded labels: discovery walks up to a few hundred variants, the negotiated one is reported on /health.
+    labels = {"phase": "poll" if conditional else "discovery"}
+    start = time.perf_counter()
+    try:
+        if method == "GET":
+            resp = session.get(target_url, headers=headers, timeout=timeout)
+        else:
+            resp = session.post(target_url, headers={**headers, "Content-Type": "application/json"}, json={}, timeout=timeout)
+    except requests.exceptions.RequestException as e:
+        metric_observe("idfm_upstream_request_seconds", time.perf_counter() - start, labels)
+        metric_inc("idfm_upstream_requests_total", dict(labels, method=method, status="error"))
+        return None, str(e), None
+    metric_observe("idfm_upstream_request_seconds", time.perf_counter() - start, labels)
+    metric_inc("idfm_upstream_requests_total", dict(labels, method=method, status=str(resp.status_code)))
+    try:
+        api_diag.update({
+            "last_url": target_url,
+            "last_method": method,
+            "last_headers": list(headers.keys()),
+            "last_status": resp.status_code,
+        })
+        if known and resp.status_code == 304:
+            return NOT_MODIFIED, None, None
+        if resp.status_code >= 400:
+            return None, f"{resp.status_code} {method} {target_url} with headers {list(headers.keys())}", None
+        # Hash the body before decoding so that identical payloads skip JSON parsing entirely.
+        digest = hashlib.sha256(resp.content).hexdigest()
+        if known and digest == upstream_validators["hash"]:
+            return NOT_MODIFIED, None, None
+        body = resp.content
+        if body.lstrip()[:1] not in (b"{", b"["):
+            raise ValueError("not a JSON document")
+        if not known:
+            json.loads(body)  # full validation before an endpoint gets negotiated
+        validators = {"etag": resp.headers.get("ETag"), "last_modified": resp.headers.get("Last-Modified"), "hash": digest}
+        return body, None, validators
+    except ValueError:
+        return None, f"Invalid JSON from {method} {target_url}", None
+
+
+def load_endpoint_cache():
+    try:
+        if os.path.exists(ENDPOINT_CACHE_PATH):
+            with open(ENDPOINT_CACHE_PATH, "r", encoding="utf-8") as f:
+                variant = json.load(f).get("variant")
+            # Ignore a cached endpoint that no longer matches the configured base URL.
+            if variant and variant.get("url") in API_URL_CANDIDATES:
+                return variant
+    except Exception as e:
+        print(f"Warning: could not load endpoint cache: {e}")
+    return None
+
+
+def save_endpoint_cache(variant):
+    try:
+        os.makedirs(os.path.dirname(ENDPOINT_CACHE_PATH), exist_ok=True)
+        tmp = ENDPOINT_CACHE_PATH + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"variant": variant, "savedAt": datetime.now(timezone.utc).isoformat()}, f, ensure_ascii=False)
+        os.replace(tmp, ENDPOINT_CACHE_PATH)
+    except Exception as e:
+        print(f"Warning: could not save endpoint cache: {e}")
+
+
+def _endpoint_succeeded(variant, validators=None):
+    if validators is not None:
+        pending_validators.update(variant=_variant_label(variant), validators=validators)
+    if variant != endpoint_state["variant"]:
+        endpoint_state["variant"] = variant
+        save_endpoint_cache(variant)
+    endpoint_state.update({"failures": 0, "next_discovery": 0, "backoff": CACHE_DURATION})
+    api_diag.update({"ok": True, "negotiated": _variant_label(variant), "endpoint_failures": 0, "next_discovery": None})
+
+
+def commit_validators(accepted):
+    """Trust the pending validators once their body was installed; forget all validators when it was rejected.
+
+    A rejected body must be fetched and checked again rather than reported as unchanged.
+    """
+    if accepted and pending_validators["validators"] is not None:
+        upstream_validators.update(pending_validators["validators"], variant=pending_validators["variant"])
+    elif not accepted:
+        upstream_validators.update({"variant": None, "etag": None, "last_modified": None, "hash": None})
+    pending_validators.update(variant=None, validators=None)
+
+
+def _race_variants(variants):
+    """Probe ``variants`` concurrently; returns (variant, data, validators) for the first valid JSON response.
+
+    When every probe fails, the third element is the last error instead.
+    """
+    failed = api_diag["failed_variants"]
+    last_error = None
+    pool = ThreadPoolExecutor(max_workers=max(UPSTREAM_PROBE_CONCURRENCY, 1), thread_name_prefix="probe")
+    futures = {pool.submit(_try_variant, v): v for v in variants}
+    try:
+        for fut in as_completed(futures):
+            variant = futures[fut]
+            data, error, validators = fut.result()
+            if error is None:
+                return variant, data, validators
+            last_error = error
+            failed.append(f"{_variant_label(variant)}: {error}")
+    finally:
+        # Losing probes still in flight finish in the background; queued ones are dropped.
+        pool.shutdown(wait=False, cancel_futures=True)
+    return None, None, last_error
 
 
 def get_api_data():
-    """Fetch PRIM data trying several URL/header/method variants."""
-    header_variants = [
-        {"apikey": API_KEY, "Accept": "application/json"},
-        {"apiKey": API_KEY, "Accept": "application/json"},
-        {"X-API-KEY": API_KEY, "Accept": "application/json"},
-        {"Authorization": f"Apikey {API_KEY}", "Accept": "application/json"},
-    ]
-    api_diag.update({"last_url": None, "last_method": None, "last_headers": None, "last_status": None, "last_error": None, "ok": False})
+    """Fetch the raw PRIM body, trying the negotiated endpoint first and rediscovering only after repeated failures."""
+    api_diag.update({"last_url": None, "last_method": None, "last_headers": None, "last_status": None, "last_error": None, "ok": False,
+                     "failed_variants": []})
+    if not endpoint_state["loaded"]:
+        endpoint_state["variant"] = load_endpoint_cache()
+        endpoint_state["loaded"] = True
+    failed = api_diag["failed_variants"]
     last_error = None
-    methods = ("GET", "POST")
-    for url in API_URL_CANDIDATES:
-        qs_variants = [
-            url,
-            (url + ("&" if "?" in url else "?") + f"apiKey={API_KEY}") if API_KEY else url,
-            (url + ("&" if "?" in url else "?") + f"apikey={API_KEY}") if API_KEY else url,
-            (url + ("&" if "?" in url else "?") + f"key={API_KEY}") if API_KEY else url,
-        ]
-        for target_url in qs_variants:
-            for headers in header_variants:
-                for method in methods:
-                    try:
-                        if method == "GET":
-                            resp = requests.get(target_url, headers=headers, timeout=20)
-                        else:
-                            resp = requests.post(target_url, headers={**headers, "Content-Type": "application/json"}, json={}, timeout=20)
-                        api_diag.update({
-                            "last_url": target_url,
-                            "last_method": method,
-                            "last_headers": list(headers.keys()),
-                            "last_status": resp.status_code,
-                        })
-                        if resp.status_code >= 400:
-                            last_error = f"{resp.status_code} {method} {target_url} with headers {list(headers.keys())}"
-                            continue
-                        data = resp.json()
-                        api_diag["ok"] = True
-                        return data
-                    except requests.exceptions.RequestException as e:
-                        last_error = str(e)
-                        api_diag["last_error"] = last_error
-                    except ValueError:
-                        last_error = f"Invalid JSON from {method} {target_url}"
-                        api_diag["last_error"] = last_error
-                        continue
-    api_diag["last_error"] = last_error
+
+    variant = endpoint_state["variant"]
+    if variant:
+        data, last_error, validators = _try_variant(variant, conditional=True)
+        if last_error is None:
+            api_diag["unchanged"] = data is NOT_MODIFIED
+            _endpoint_succeeded(variant, validators)
+            return data
+        failed.append(f"{_variant_label(variant)}: {last_error}")
+        endpoint_state["failures"] += 1
+        api_diag.update({"endpoint_failures": endpoint_state["failures"], "last_error": last_error})
+        if endpoint_state["failures"] < ENDPOINT_MAX_FAILURES:
+            return None
+
+    now = time.time()
+    if now < endpoint_state["next_discovery"]:
+        api_diag["last_error"] = last_error or "endpoint discovery backing off"
+        return None
+
+    winner, data, extra = _race_variants([c for c in _api_variants() if c != variant])
+    if winner is not None:
+        api_diag["unchanged"] = False
+        _endpoint_succeeded(winner, extra)
+        return data
+    last_error = extra or last_error
+
+    # Discovery failed: back off exponentially before walking the whole list again.
+    endpoint_state["next_discovery"] = now + endpoint_state["backoff"]
+    endpoint_state["backoff"] = min(endpoint_state["backoff"] * 2, ENDPOINT_BACKOFF_MAX)
+    api_diag.update({"last_error": last_error, "next_discovery": datetime.fromtimestamp(endpoint_state["next_discovery"], timezone.utc).isoformat()})
     return None
 
 
-def normalize_data(data):
-    """Normalize upstream payload to a stable schema: {updatedAt, items[], meta}."""
-    normalized = {
+_MISSING = object()
+
+
+class Item:
+    """Compact normalized item; turned into a dict only when serialized."""
+
+    __slots__ = ("line", "message", "severity", "cause", "lastUpdate", "id", "source", "network", "lineCode", "chip", "key")
+
+    def __init__(self, line=None, message=None, severity=None, cause=_MISSING, lastUpdate=_MISSING, id=None, source=None,
+                 mode=None):
+        # Shared strings (line names, severities, causes, messages) are interned across items and snapshots.
+        self.line = _intern(line)
+        self.message = _intern(message)
+        self.severity = _intern(severity)
+        # Absent fields leave their slot unset rather than holding _MISSING, which would not survive pickling
+        # (reindex workers send items back across processes).
+        if cause is not _MISSING:
+            self.cause = _intern(cause)
+        if lastUpdate is not _MISSING:
+            self.lastUpdate = lastUpdate
+        self.id = id
+        self.source = source
+        self.network, self.lineCode, self.chip = resolve_line(self.line, mode if isinstance(mode, str) else None)
+
+    @classmethod
+    def from_dict(cls, d):
+        """Rebuild an item serialized by as_dict(), e.g. read back from the shared snapshot."""
+        item = cls.__new__(cls)
+        for k in cls.__slots__:
+            if k in d:
+                setattr(item, k, _intern(d[k]) if k in ("line", "message", "severity", "cause") else d[k])
+        return item
+
+    def get(self, name, default=None):
+        value = getattr(self, name, _MISSING)
+        return default if value is _MISSING else value
+
+    def __getitem__(self, name):
+        value = getattr(self, name, _MISSING)
+        if value is _MISSING:
+            raise KeyError(name)
+        return value
+
+    def __setitem__(self, name, value):
+        setattr(self, name, value)
+
+    def _values(self):
+        return tuple(getattr(self, k, _MISSING) for k in self.__slots__)
+
+    def __eq__(self, other):
+        return isinstance(other, Item) and self._values() == other._values()
+
+    __hash__ = None
+
+    def as_dict(self):
+        return {k: v for k, v in zip(self.__slots__, self._values()) if v is not _MISSING}
+
+
+# Line identity: (network, code, chip CSS class) resolved once per distinct (name, mode) pair.
+LINE_MODES = {
+    "metro": "metro", "subway": "metro",
+    "rer": "rer", "rapidtransit": "rer", "localtrain": "train", "train": "train", "transilien": "train",
+    "tramway": "tram", "tram": "tram",
+    "bus": "bus", "coach": "bus", "noctilien": "bus",
+}
+LINE_PATTERNS = (
+    ("metro", re.compile(r"\b(?:METRO|M)\s*(\d{1,2}(?:BIS)?)\b")),
+    ("rer", re.compile(r"\bRER\s*([A-E])\b")),
+    ("tram", re.compile(r"\bT(?:RAM)?\s*(\d{1,2}[A-C]?)\b")),
+    ("bus", re.compile(r"\b(?:BUS|NOCTILIEN)\s*(N?\d+\w*)\b")),
+)
+
+
+def _line_code(network, code):
+    code = code.upper()
+    if network == "tram" and not code.startswith("T"):
+        code = "T" + code
+    return code
+
+
+def _line_chip(network, code):
+    if network == "metro":
+        return f"chip metro m{code.replace('BIS', '')}"
+    if network == "rer":
+        return f"chip rer r{code.lower()}"
+    if network in ("tram", "bus"):
+        return f"chip {network}"
+    return "chip noir"
+
+
+@lru_cache(maxsize=4096)
+def resolve_line(name, mode=None):
+    """Canonical (network, code, chip class) of a line from its display name and optional PRIM mode."""
+    if not name:
+        return None, None, None
+    text = unicodedata.normalize("NFKD", str(name)).encode("ascii", "ignore").decode("ascii").upper().strip()
+    network = LINE_MODES.get(re.sub(r"[^a-z]", "", str(mode).lower())) if mode else None
+    for net, pattern in LINE_PATTERNS:
+        if network is not None and net != network:
+            continue
+        m = pattern.search(text)
+        if m:
+            network, code = net, _line_code(net, m.group(1))
+            break
+    else:
+        # Bare names ("4", "A", "T3a") are only meaningful with a mode hint.
+        code = _line_code(network, text) if network else text
+    return network, _intern(code), _line_chip(network, code)
+
+
+def filter_items(items, network=None, line=None):
+    """Items matching a network (metro, rer, tram, bus, train) and/or a line code (e.g. '4', 'A', 'T3a')."""
+    network = network.lower() if network else None
+    code = _line_code(network, line) if line else None
+    return [it for it in items
+            if (network is None or it.get("network") == network) and (code is None or it.get("lineCode") == code)]
+
+
+def _intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+def _json_default(obj):
+    if isinstance(obj, Item):
+        return obj.as_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _empty_normalized():
+    return {
         "updatedAt": datetime.now(timezone.utc).isoformat(),
         "items": [],
-        "meta": {"api": {k: api_diag.get(k) for k in ["ok", "last_url", "last_method", "last_headers", "last_status", "last_error"]}},
+        "meta": {"api": {k: api_diag.get(k) for k in API_DIAG_KEYS[:7]}},
     }
+
+
+def _normalize_bulk(disruptions, lines, items):
+    """disruptions_bulk v2: one item per (disruption, affected object). Both arguments may be lazy iterables."""
+    line_map = {}
+    for l in lines:
+        lid = l.get("id") or l.get("lineId") or l.get("code")
+        lname = l.get("name") or l.get("label") or l.get("code")
+        if lid:
+            line_map[str(lid)] = (lname or str(lid), l.get("mode") or l.get("physical_mode") or l.get("commercial_mode"))
+    source = "disruptions_bulk_v2"
+    for d in disruptions:
+        raw_msg = d.get("title") or d.get("message") or d.get("cause") or "N/A"
+        msg = unescape(re.sub(r"<[^>]*>", " ", str(raw_msg))).strip()
+        severity = d.get("severity")
+        cause = d.get("cause")
+        last_update = d.get("lastUpdate")
+        affected = d.get("affected_objects") or d.get("impacted_objects") or []
+        if not affected:
+            items.append(Item(None, msg, severity, cause, last_update, d.get("id"), source))
+            continue
+        for a in affected:
+            pt = a.get("pt_object") or a.get("pt_line") or {}
+            line_id = pt.get("id") or pt.get("lineId") or pt.get("code")
+            mapped_name, mode = line_map.get(str(line_id), (None, None)) if line_id else (None, None)
+            line_name = pt.get("name") or pt.get("label") or mapped_name or (str(line_id) if line_id else None)
+            items.append(Item(line_name, msg, severity, cause, last_update, d.get("id"), source, mode or pt.get("mode")))
+
+
+def normalize_data(data):
+    """Normalize upstream payload to a stable schema: {updatedAt, items[], meta}."""
+    normalized = _empty_normalized()
     if not data:
         return normalized
 
     # disruptions_bulk v2
     disruptions = data.get("disruptions") if isinstance(data, dict) else None
     if isinstance(disruptions, list):
-        line_map = {}
         lines = data.get("lines") or []
-        if isinstance(lines, list):
-            for l in lines:
-                lid = l.get("id") or l.get("lineId") or l.get("code")
-                lname = l.get("name") or l.get("label") or l.get("code")
-                if lid:
-                    line_map[str(lid)] = lname or str(lid)
-        for d in disruptions:
-            raw_msg = d.get("title") or d.get("message") or d.get("cause") or "N/A"
-            msg = unescape(re.sub(r"<[^>]*>", " ", str(raw_msg))).strip()
-            severity = d.get("severity")
-            cause = d.get("cause")
-            last_update = d.get("lastUpdate")
-            affected = d.get("affected_objects") or d.get("impacted_objects") or []
-            if not affected:
-                normalized["items"].append({
-                    "line": None,
-                    "message": msg,
-                    "severity": severity,
-                    "cause": cause,
-                    "lastUpdate": last_update,
-                    "id": d.get("id"),
-                    "source": "disruptions_bulk_v2",
-                })
-                continue
-            for a in affected:
-                pt = a.get("pt_object") or a.get("pt_line") or {}
-                line_id = pt.get("id") or pt.get("lineId") or pt.get("code")
-                line_name = pt.get("name") or pt.get("label") or (line_map.get(str(line_id)) if line_id else None) or (str(line_id) if line_id else None)
-                normalized["items"].append({
-                    "line": line_name,
-                    "message": msg,
-                    "severity": severity,
-                    "cause": cause,
-                    "lastUpdate": last_update,
-                    "id": d.get("id"),
-                    "source": "disruptions_bulk_v2",
-                })
+        _normalize_bulk(disruptions, lines if isinstance(lines, list) else [], normalized["items"])
         return normalized
 
     # Fallback: Siri GeneralMessage
@@ -177,13 +730,25 @@ def normalize_data(data):
             message_text = content.get("Message", [{}])[0].get("MessageText", {}).get("value", "N/A")
             affected_lines = content.get("AffectedLine", [])
             if not affected_lines:
-                normalized["items"].append({"line": None, "message": message_text, "severity": None, "id": None, "source": "Siri-GeneralMessage"})
+                normalized["items"].append(Item(None, message_text, None, id=None, source="Siri-GeneralMessage"))
             for al in affected_lines:
                 line_name = al.get("LineRef", {}).get("value")
-                normalized["items"].append({"line": line_name, "message": message_text, "severity": None, "id": None, "source": "Siri-GeneralMessage"})
+                normalized["items"].append(Item(line_name, message_text, None, id=None, source="Siri-GeneralMessage"))
     return normalized
 
 
+def normalize_raw(raw):
+    """Normalize a raw upstream body, streaming disruptions_bulk payloads when ijson is installed."""
+    if ijson is not None and raw and b'"disruptions"' in raw:
+        normalized = _empty_normalized()
+        # Two lazy passes over the body: the line map first, then one disruption at a time.
+        lines = ijson.items(io.BytesIO(raw), "lines.item", use_float=True)
+        disruptions = ijson.items(io.BytesIO(raw), "disruptions.item", use_float=True)
+        _normalize_bulk(disruptions, lines, normalized["items"])
+        return normalized
+    return normalize_data(json.loads(raw) if raw else None)
+
+
 def load_history():
     try:
         if os.path.exists(HISTORY_PATH):
@@ -201,27 +766,374 @@ def save_history(history):
         with open(tmp, "w", encoding="utf-8") as f:
             json.dump(history, f, ensure_ascii=False, indent=2)
         os.replace(tmp, HISTORY_PATH)
+        return True
     except Exception as e:
         print(f"Warning: could not save history: {e}")
+        return False
 
 
-def update_history(normalized):
+# In-memory history: history.json is the last compacted state, history.log.jsonl the entries appended since.
+history_state = {"history": None, "ids": {}, "log_records": 0, "encoded": None, "stamp": None}
+history_lock = Lock()
+
+
+def _history_stamp():
+    stamp = []
+    for path in (HISTORY_PATH, HISTORY_LOG_PATH):
+        try:
+            st = os.stat(path)
+            stamp.append((st.st_mtime_ns, st.st_size))
+        except OSError:
+            stamp.append(None)
+    return tuple(stamp)
+
+
+def _append_history_entry(line, entry):
+    """Add ``entry`` to ``line`` unless its id is already known; returns True when added."""
+    per_line = history_state["history"].setdefault("perLine", {})
+    ids = history_state["ids"].setdefault(line, set())
+    if entry.get("id") in ids:
+        return False
+    lst = per_line.setdefault(line, [])
+    lst.append(entry)
+    ids.add(entry.get("id"))
+    if len(lst) > HISTORY_PER_LINE:
+        for old in lst[:-HISTORY_PER_LINE]:
+            ids.discard(old.get("id"))
+        del lst[:-HISTORY_PER_LINE]
+    return True
+
+
+def _load_history_state():
+    """Load history.json and replay the append-only log once; callers hold history_lock.
+
+    Followers do not write history, so they reload whenever the poller changed the files.
+    """
+    if history_state["history"] is not None:
+        if serving_state["role"] != "follower" or history_state["stamp"] == _history_stamp():
+            return history_state["history"]
+    stamp = _history_stamp()
     history = load_history()
-    per_line = history.get("perLine", {})
+    per_line = history.setdefault("perLine", {})
+    history_state.update({"history": history, "ids": {}, "log_records": 0, "encoded": None, "stamp": stamp})
+    for line, lst in per_line.items():
+        del lst[:-HISTORY_PER_LINE]
+        history_state["ids"][line] = {e.get("id") for e in lst}
+    try:
+        if os.path.exists(HISTORY_LOG_PATH):
+            with open(HISTORY_LOG_PATH, "r", encoding="utf-8") as f:
+                for raw in f:
+                    try:
+                        rec = json.loads(raw)
+                    except ValueError:
+                        continue  # torn write at the end of the log
+                    _append_history_entry(rec.pop("line"), rec)
+                    history["lastUpdated"] = rec.get("ts") or history.get("lastUpdated")
+                    history_state["log_records"] += 1
+    except Exception as e:
+        print(f"Warning: could not replay history log: {e}")
+    return history
+
+
+def compact_history():
+    """Rewrite history.json from memory and truncate the append-only log; callers hold history_lock."""
+    with timed("history_save"):
+        saved = save_history(history_state["history"])
+    if saved:
+        try:
+            open(HISTORY_LOG_PATH, "w", encoding="utf-8").close()
+            history_state["log_records"] = 0
+        except Exception as e:
+            print(f"Warning: could not truncate history log: {e}")
+
+
+def update_history(normalized):
     ts = normalized.get("updatedAt")
-    for it in normalized.get("items", []):
-        line = it.get("line") or "unknown"
-        entry_id = it.get("id")
-        if not entry_id:
-            continue
-        lst = per_line.get(line, [])
-        if not any(e.get("id") == entry_id for e in lst):
-            lst.append({"id": entry_id, "ts": ts, "message": it.get("message"), "severity": it.get("severity"), "cause": it.get("cause")})
-            lst = lst[-100:]
-            per_line[line] = lst
-    history["perLine"] = per_line
-    history["lastUpdated"] = ts
-    save_history(history)
+    with history_lock:
+        history = _load_history_state()
+        added = []
+        for it in normalized.get("items", []):
+            line = it.get("line") or "unknown"
+            entry_id = it.get("id")
+            if not entry_id:
+                continue
+            entry = {"id": entry_id, "ts": ts, "message": it.get("message"), "severity": it.get("severity"), "cause": it.get("cause")}
+            if _append_history_entry(line, entry):
+                added.append({"line": line, **entry})
+        history["lastUpdated"] = ts
+        history_state["encoded"] = None
+        if not added:
+            return
+        try:
+            os.makedirs(os.path.dirname(HISTORY_LOG_PATH), exist_ok=True)
+            with open(HISTORY_LOG_PATH, "a", encoding="utf-8") as f:
+                f.write("".join(json.dumps(rec, ensure_ascii=False, separators=(",", ":")) + "\n" for rec in added))
+            history_state["log_records"] += len(added)
+        except Exception as e:
+            print(f"Warning: could not append to history log: {e}")
+        if history_state["log_records"] >= HISTORY_COMPACT_AFTER:
+            compact_history()
+
+
+def _history_epoch(entry):
+    try:
+        return datetime.fromisoformat(entry["ts"]).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def replace_history_range(results, lo, hi):
+    """Replace the history entries first seen in [lo, hi) with those rebuilt from ``results`` ([(epoch, normalized)]).
+
+    Entries are merged in time order before the per-line cap, so archived days never push newer ones out, and
+    lastUpdated never moves backwards. Callers compact afterwards.
+    """
+    rebuilt = {}
+    last_ts = None
+    for _, norm in results:
+        ts = norm.get("updatedAt")
+        last_ts = ts or last_ts
+        for it in norm.get("items", []):
+            entry_id = it.get("id")
+            if not entry_id:
+                continue
+            line = it.get("line") or "unknown"
+            rebuilt.setdefault(line, {}).setdefault(entry_id, {
+                "id": entry_id, "ts": ts, "message": it.get("message"), "severity": it.get("severity"), "cause": it.get("cause")})
+    with history_lock:
+        history = _load_history_state()
+        per_line = history.setdefault("perLine", {})
+        for line in set(per_line) | set(rebuilt):
+            kept = [e for e in per_line.get(line, []) if not (lo <= (_history_epoch(e) or -1) < hi)]
+            merged = sorted(kept + list(rebuilt.get(line, {}).values()), key=lambda e: _history_epoch(e) or 0)
+            entries = []
+            ids = set()
+            for e in merged:  # an id seen on both sides keeps its earliest sighting
+                if e.get("id") not in ids:
+                    ids.add(e.get("id"))
+                    entries.append(e)
+            entries = entries[-HISTORY_PER_LINE:]
+            per_line[line] = entries
+            history_state["ids"][line] = {e.get("id") for e in entries}
+        newest = _history_epoch({"ts": last_ts})
+        if newest is not None and newest > (_history_epoch({"ts": history.get("lastUpdated")}) or 0):
+            history["lastUpdated"] = last_ts
+        history_state["encoded"] = None
+
+
+def history_body():
+    """Encoded /history.json body, re-serialized only after the history changed."""
+    with history_lock:
+        history = _load_history_state()
+        if history_state["encoded"] is None:
+            history_state["encoded"] = encode_body(history)
+        return history_state["encoded"]
+
+
+def history_updated():
+    """Epoch of the history's lastUpdated, or None."""
+    with history_lock:
+        return _history_epoch({"ts": _load_history_state().get("lastUpdated")})
+
+
+def history_for_line(line):
+    with history_lock:
+        return list(_load_history_state().get("perLine", {}).get(line, []))
+
+
+# Indexed history: one row per occurrence of an item (disruption on a line) with the time span it was visible.
+HISTORY_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS occurrences (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL,
+    disruption_id TEXT,
+    line TEXT,
+    severity TEXT,
+    cause TEXT,
+    message TEXT,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS occ_key ON occurrences(key, last_seen);
+CREATE INDEX IF NOT EXISTS occ_first ON occurrences(first_seen);
+CREATE INDEX IF NOT EXISTS occ_last ON occurrences(last_seen);
+CREATE INDEX IF NOT EXISTS occ_line ON occurrences(line, first_seen);
+CREATE INDEX IF NOT EXISTS occ_severity ON occurrences(severity, first_seen);
+CREATE INDEX IF NOT EXISTS occ_cause ON occurrences(cause, first_seen);
+"""
+index_state = {"open": None}  # item key -> (row id, last_seen) for occurrences still visible
+index_lock = Lock()
+db_state = {"path": None, "writer": None, "readers": None}
+db_lock = Lock()
+
+
+def _connect_history_db():
+    conn = sqlite3.connect(HISTORY_DB_PATH, timeout=30, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def history_db():
+    """The single writer connection to the history index; callers hold index_lock.
+
+    The schema and WAL mode are set up once per process, on first use.
+    """
+    with db_lock:
+        if db_state["path"] != HISTORY_DB_PATH:
+            os.makedirs(os.path.dirname(HISTORY_DB_PATH), exist_ok=True)
+            conn = _connect_history_db()
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(HISTORY_DB_SCHEMA)
+            db_state.update(path=HISTORY_DB_PATH, writer=conn, readers=queue.LifoQueue())
+        return db_state["writer"]
+
+
+@contextmanager
+def history_reader():
+    """A pooled read-only connection; WAL lets queries run alongside the writer."""
+    history_db()
+    readers = db_state["readers"]
+    try:
+        conn = readers.get_nowait()
+    except queue.Empty:
+        conn = _connect_history_db()
+        conn.execute("PRAGMA query_only=ON")
+    try:
+        yield conn
+    finally:
+        if readers.qsize() < HISTORY_DB_READERS:
+            readers.put(conn)
+        else:
+            conn.close()
+
+
+def index_snapshot(normalized, ts, gap=None):
+    """Extend or open occurrences for every item of a normalized snapshot taken at epoch ``ts``."""
+    gap = HISTORY_DB_GAP if gap is None else gap
+    with index_lock:
+        conn = history_db()
+        if index_state["open"] is None:
+            index_state["open"] = {}
+            for row in conn.execute("SELECT key, id, last_seen FROM occurrences WHERE last_seen >= ? ORDER BY last_seen",
+                                    (ts - gap,)):
+                index_state["open"][row["key"]] = (row["id"], row["last_seen"])
+        previous = index_state["open"]
+        current = {}
+        with conn:
+            for it in normalized.get("items", []):
+                key = it.get("key") or item_key(it)
+                if key in current:
+                    continue
+                fields = (it.get("severity"), it.get("cause"), it.get("message"))
+                prev = previous.get(key)
+                if prev is not None and 0 <= ts - prev[1] <= gap:
+                    conn.execute("UPDATE occurrences SET last_seen = ?, severity = ?, cause = ?, message = ? WHERE id = ?",
+                                 (ts, *fields, prev[0]))
+                    current[key] = (prev[0], ts)
+                else:
+                    cur = conn.execute(
+                        "INSERT INTO occurrences (key, disruption_id, line, severity, cause, message, first_seen, last_seen)"
+                        " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (key, it.get("id"), it.get("line"), *fields, ts, ts))
+                    current[key] = (cur.lastrowid, ts)
+        index_state["open"] = current
+
+
+def touch_index(ts):
+    """Extend every open occurrence to ``ts`` when upstream reported no change."""
+    with index_lock:
+        current = index_state["open"]
+        if not current:
+            return
+        with history_db() as conn:
+            conn.executemany("UPDATE occurrences SET last_seen = ? WHERE id = ?", [(ts, rid) for rid, _ in current.values()])
+        index_state["open"] = {k: (rid, ts) for k, (rid, _) in current.items()}
+
+
+def _epoch_iso(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat()
+
+
+def _occurrence(row):
+    return {
+        "id": row["disruption_id"],
+        "key": row["key"],
+        "line": row["line"],
+        "severity": row["severity"],
+        "cause": row["cause"],
+        "message": row["message"],
+        "firstSeen": _epoch_iso(row["first_seen"]),
+        "lastSeen": _epoch_iso(row["last_seen"]),
+    }
+
+
+def _history_filters(line=None, start=None, end=None, severity=None, cause=None):
+    clauses, params = [], []
+    for column, value in (("line", line), ("severity", severity), ("cause", cause)):
+        if value is not None:
+            clauses.append(f"{column} = ?")
+            params.append(value)
+    if start is not None:
+        clauses.append("last_seen >= ?")
+        params.append(start)
+    if end is not None:
+        clauses.append("first_seen <= ?")
+        params.append(end)
+    return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+
+def query_history(line=None, start=None, end=None, severity=None, cause=None, limit=100, offset=0):
+    """Occurrences overlapping [start, end] (epoch seconds), newest first."""
+    where, params = _history_filters(line, start, end, severity, cause)
+    with history_reader() as conn:
+        total = conn.execute(f"SELECT COUNT(*) FROM occurrences{where}", params).fetchone()[0]
+        rows = conn.execute(f"SELECT * FROM occurrences{where} ORDER BY first_seen DESC, id DESC LIMIT ? OFFSET ?",
+                            (*params, limit, offset)).fetchall()
+    return {"total": total, "limit": limit, "offset": offset, "items": [_occurrence(r) for r in rows]}
+
+
+def aggregate_history(line=None, start=None, end=None, severity=None, cause=None):
+    """Disruption minutes and occurrence counts per line per (UTC) day, clipped to [start, end]."""
+    where, params = _history_filters(line, start, end, severity, cause)
+    totals = {}
+    with history_reader() as conn:
+        occurrences = conn.execute(f"SELECT line, first_seen, last_seen FROM occurrences{where}", params).fetchall()
+    for row in occurrences:
+        lo = max(row["first_seen"], start) if start is not None else row["first_seen"]
+        hi = min(row["last_seen"], end) if end is not None else row["last_seen"]
+        day = datetime.fromtimestamp(lo, timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+        first_day = True
+        while True:
+            day_end = day.timestamp() + 86400
+            key = (row["line"] or "unknown", day.date().isoformat())
+            agg = totals.setdefault(key, {"line": key[0], "day": key[1], "minutes": 0.0, "count": 0})
+            agg["minutes"] += max(0.0, min(hi, day_end) - lo) / 60
+            if first_day:
+                agg["count"] += 1
+                first_day = False
+            if hi <= day_end:
+                break
+            lo = day_end
+            day = datetime.fromtimestamp(day_end, timezone.utc)
+    rows = sorted(totals.values(), key=lambda a: (a["day"], a["line"]))
+    for agg in rows:
+        agg["minutes"] = round(agg["minutes"], 1)
+    return rows
+
+
+def parse_time_arg(value):
+    """Accept epoch seconds or an ISO 8601 date/datetime (naive values are UTC)."""
+    if value is None or value == "":
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
 
 
 def ensure_git_repo(repo_path: str):
@@ -244,233 +1156,1556 @@ def ensure_git_repo(repo_path: str):
     return repo
 
 
-def archive_to_github(data):
-    """Write raw and normalized snapshots with unique names, commit, and best-effort push."""
+# Archival pipeline: snapshots are queued, appended to compressed daily segments and committed in batches
+# by a single background worker, which also retries failed pushes.
+archive_queue = queue.Queue(maxsize=ARCHIVE_QUEUE_SIZE)
+archive_flush = Event()
+archive_state = {"thread": None, "repo": None, "last_hash": None, "pending_paths": set(), "last_commit": time.time(),
+                 "push_pending": False, "next_push": 0, "push_backoff": 30, "last_error": None, "written": 0, "skipped": 0,
+                 "segment": None, "segment_objects": set()}
+archive_lock = Lock()
+
+
+def archive_segment_path(day: str):
+    ext = "zst" if zstandard is not None else "gz"
+    return os.path.join(REPO_PATH, "data", day, f"snapshots.jsonl.{ext}")
+
+
+def read_archive_segment(path: str):
+    """Yield the records of a daily segment written by write_archive_record()."""
+    with open(path, "rb") as f:
+        if path.endswith(".zst"):
+            reader = zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+            lines = io.TextIOWrapper(reader, encoding="utf-8")
+        else:
+            lines = gzip.open(f, "rt", encoding="utf-8")
+        for raw in lines:
+            if raw.strip():
+                yield json.loads(raw)
+
+
+def write_archive_record(record, when):
+    """Append ``record`` as one compressed frame to the segment of its day; returns the segment path."""
+    path = archive_segment_path(datetime.fromtimestamp(when).strftime("%Y-%m-%d"))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    line = json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+    frame = zstandard.ZstdCompressor().compress(line) if zstandard is not None else gzip.compress(line, mtime=0)
+    with open(path, "ab") as f:
+        end = f.tell()
+        try:
+            f.write(frame)
+            f.flush()
+        except OSError:
+            f.truncate(end)  # drop a partial frame so that later appends stay readable
+            raise
+    return path
+
+
+def _object_hash(obj):
+    # Insertion order is kept so that inflate_snapshot() reproduces the payload byte for byte.
+    return hashlib.sha256(json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")).hexdigest()[:32]
+
+
+def deflate_snapshot(data, known):
+    """Split ``data`` into a manifest whose disruption/line lists reference objects by content hash.
+
+    Returns (manifest, objects) where ``objects`` only holds hashes missing from ``known``. ``known`` is left as is:
+    callers add the new hashes once the record holding them is stored.
+    """
+    if not isinstance(data, dict):
+        return data, {}
+    manifest = {}
+    objects = {}
+    for key, value in data.items():
+        if key in CONTENT_ADDRESSED_KEYS and isinstance(value, list):
+            refs = []
+            for obj in value:
+                h = _object_hash(obj)
+                refs.append(h)
+                if h not in known and h not in objects:
+                    objects[h] = obj
+            manifest[key] = {"$refs": refs}
+        else:
+            manifest[key] = value
+    return manifest, objects
+
+
+def inflate_snapshot(manifest, objects):
+    """Rebuild a payload from its manifest and the content-addressed ``objects`` seen so far."""
+    if not isinstance(manifest, dict):
+        return manifest
+    data = {}
+    for key, value in manifest.items():
+        if key in CONTENT_ADDRESSED_KEYS and isinstance(value, dict) and "$refs" in value:
+            data[key] = [objects[h] for h in value["$refs"]]
+        else:
+            data[key] = value
+    return data
+
+
+def iter_archive_snapshots(path: str):
+    """Yield (ts, payload) for every snapshot of a daily segment, in write order."""
+    objects = {}
+    for rec in read_archive_segment(path):
+        if "raw" in rec:  # records written before content addressing
+            yield rec["ts"], rec["raw"]
+            continue
+        objects.update(rec.get("objects") or {})
+        yield rec["ts"], inflate_snapshot(rec["manifest"], objects)
+
+
+def archive_pack_path(day: str):
+    return os.path.join(REPO_PATH, "data", day, "snapshots.pack")
+
+
+def write_archive_pack(path: str, snapshots, resolution=0):
+    """Write [(epoch, payload)] as a seekable pack: independently compressed blocks followed by a JSON offset index.
+
+    Objects are content-addressed within each block, so reading one snapshot decompresses at most one block.
+    """
+    codec = "zst" if zstandard is not None else "gz"
+    index = {"format": 1, "codec": codec, "resolution": resolution, "blocks": [], "snapshots": []}
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        for start in range(0, len(snapshots), ARCHIVE_PACK_BLOCK):
+            known = set()
+            lines = []
+            for pos, (ts, data) in enumerate(snapshots[start:start + ARCHIVE_PACK_BLOCK]):
+                manifest, objects = deflate_snapshot(data, known)
+                known.update(objects)
+                record = {"ts": datetime.fromtimestamp(ts, timezone.utc).isoformat(), "manifest": manifest, "objects": objects}
+                lines.append(json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+                index["snapshots"].append([ts, len(index["blocks"]), pos])
+            body = b"\n".join(lines)
+            block = zstandard.ZstdCompressor(level=10).compress(body) if codec == "zst" else gzip.compress(body, 9, mtime=0)
+            index["blocks"].append([f.tell(), len(block)])
+            f.write(block)
+        footer = json.dumps(index, separators=(",", ":")).encode("utf-8")
+        f.write(footer)
+        f.write(len(footer).to_bytes(8, "big"))
+    os.replace(tmp, path)
+
+
+def read_pack_index(path: str):
+    with open(path, "rb") as f:
+        f.seek(-8, os.SEEK_END)
+        size = int.from_bytes(f.read(8), "big")
+        f.seek(-8 - size, os.SEEK_END)
+        return json.loads(f.read(size))
+
+
+def _read_pack_block(f, index, block):
+    offset, length = index["blocks"][block]
+    f.seek(offset)
+    raw = f.read(length)
+    body = zstandard.ZstdDecompressor().decompress(raw) if index["codec"] == "zst" else gzip.decompress(raw)
+    objects = {}
+    snapshots = []
+    for line in body.split(b"\n"):
+        rec = json.loads(line)
+        objects.update(rec["objects"])
+        snapshots.append((rec["ts"], inflate_snapshot(rec["manifest"], objects)))
+    return snapshots
+
+
+def segment_snapshot_at(path: str, when: float):
+    """(ts, payload) of the last snapshot at or before epoch ``when`` in a daily segment, or None.
+
+    Records are appended in time order: the scan stops at the first one past ``when`` and only the match is inflated.
+    """
+    objects = {}
+    found = None
+    for rec in read_archive_segment(path):
+        if datetime.fromisoformat(rec["ts"]).timestamp() > when:
+            break
+        objects.update(rec.get("objects") or {})
+        found = rec
+    if found is None:
+        return None
+    if "raw" in found:
+        return found["ts"], found["raw"]
+    return found["ts"], inflate_snapshot(found["manifest"], objects)
+
+
+def iter_pack_snapshots(path: str):
+    """Yield (ts, payload) for every snapshot of a packed day."""
+    index = read_pack_index(path)
+    with open(path, "rb") as f:
+        for block in range(len(index["blocks"])):
+            yield from _read_pack_block(f, index, block)
+
+
+def pack_snapshot_at(path: str, when: float):
+    """(ts, payload) of the last packed snapshot at or before epoch ``when``, or None."""
+    index = read_pack_index(path)
+    pos = bisect.bisect_right([s[0] for s in index["snapshots"]], when) - 1
+    if pos < 0:
+        return None
+    _, block, offset = index["snapshots"][pos]
+    with open(path, "rb") as f:
+        return _read_pack_block(f, index, block)[offset]
+
+
+def _segment_objects(path: str):
+    """Object hashes already stored in the segment at ``path`` (scanned once after a restart)."""
+    if archive_state["segment"] != path:
+        known = set()
+        if os.path.exists(path):
+            try:
+                for rec in read_archive_segment(path):
+                    known.update(rec.get("objects") or {})
+            except Exception as e:
+                print(f"Warning: could not scan archive segment {path}: {e}")
+        archive_state.update({"segment": path, "segment_objects": known})
+    return archive_state["segment_objects"]
+
+
+def _archive_snapshot(when, data, normalized):
+    if isinstance(data, (bytes, bytearray)):
+        data = json.loads(data)  # decoded here, off the request path
+    digest = hashlib.sha256(json.dumps(data, sort_keys=True, ensure_ascii=False, separators=(",", ":")).encode("utf-8")).hexdigest()
+    if digest == archive_state["last_hash"]:
+        archive_state["skipped"] += 1
+        return
+    # Each daily segment is self-contained: an object is written the first time the day references it.
+    known = _segment_objects(archive_segment_path(datetime.fromtimestamp(when).strftime("%Y-%m-%d")))
+    manifest, objects = deflate_snapshot(data, known)
+    record = {"ts": datetime.fromtimestamp(when, timezone.utc).isoformat(), "hash": digest, "manifest": manifest, "objects": objects}
+    with timed("archive_write"):
+        archive_state["pending_paths"].add(write_archive_record(record, when))
+    known.update(objects)  # only now: a failed append must not leave later records pointing at missing objects
+    archive_state["last_hash"] = digest
+    archive_state["written"] += 1
+
+
+def _commit_archive():
+    if archive_state["repo"] is None:
+        archive_state["repo"] = ensure_git_repo(REPO_PATH)
+    repo = archive_state["repo"]
+    # Archive maintenance may have packed a segment away since it was written; it committed the pack instead.
+    paths = sorted(p for p in archive_state["pending_paths"] if os.path.exists(p))
+    if not paths:
+        archive_state["pending_paths"].clear()
+        archive_state["last_commit"] = time.time()
+        return
+    repo.index.add(paths)
+    author = Actor("RATP Status Bot", "bot@example.com")
+    committer = Actor("RATP Status Bot", "bot@example.com")
+    repo.index.commit(f"Data update: {datetime.now().strftime('%Y-%m-%d_%H-%M')} ({len(paths)} segment(s))",
+                      author=author, committer=committer)
+    archive_state["pending_paths"].clear()
+    archive_state["last_commit"] = time.time()
+    archive_state["push_pending"] = 'origin' in {r.name for r in repo.remotes}
+    archive_state["next_push"] = 0
+
+
+def _push_archive():
     try:
-        repo = ensure_git_repo(REPO_PATH)
-        today_str = datetime.now().strftime("%Y-%m-%d")
-        data_dir = os.path.join(REPO_PATH, "data", today_str)
-        os.makedirs(data_dir, exist_ok=True)
-
-        base_min = datetime.now().strftime("%Y-%m-%d_%H-%M")
-        candidate = base_min
-        sec = datetime.now().strftime("%S")
-
-        def make_paths(stem: str):
-            return (
-                os.path.join(data_dir, f"{stem}.json"),
-                os.path.join(data_dir, f"{stem}.normalized.json"),
-            )
-
-        file_path, norm_path = make_paths(candidate)
-        if os.path.exists(file_path) or os.path.exists(norm_path):
-            candidate = f"{base_min}-{sec}s"
-            file_path, norm_path = make_paths(candidate)
-        suffix = 1
-        while os.path.exists(file_path) or os.path.exists(norm_path):
-            candidate = f"{base_min}-{sec}s-{suffix:02d}"
-            file_path, norm_path = make_paths(candidate)
-            suffix += 1
-
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        with open(norm_path, 'w', encoding='utf-8') as f:
-            json.dump(normalize_data(data), f, ensure_ascii=False, indent=2)
-
-        repo.index.add([file_path, norm_path])
-        if repo.is_dirty(index=True, working_tree=True, untracked_files=True):
-            author = Actor("RATP Status Bot", "bot@example.com")
-            committer = Actor("RATP Status Bot", "bot@example.com")
-            repo.index.commit(f"Data update: {candidate}", author=author, committer=committer)
+        archive_state["repo"].remote(name='origin').push()
+        archive_state.update({"push_pending": False, "push_backoff": 30})
+    except Exception as pe:
+        print(f"Git push skipped/failed: {pe}")
+        archive_state["last_error"] = str(pe)
+        archive_state["next_push"] = time.time() + archive_state["push_backoff"]
+        archive_state["push_backoff"] = min(archive_state["push_backoff"] * 2, ARCHIVE_PUSH_BACKOFF_MAX)
+
+
+def archive_worker():
+    while True:
+        try:
+            item = archive_queue.get(timeout=5)
+        except queue.Empty:
+            item = None
+        try:
+            if item is not None:
+                _archive_snapshot(*item)
+            now = time.time()
+            # A forced flush waits until the snapshots queued before it have been written.
+            flush = archive_flush.is_set() and archive_queue.empty()
+            if flush:
+                archive_flush.clear()
+            if archive_state["pending_paths"] and (flush or now - archive_state["last_commit"] >= ARCHIVE_COMMIT_INTERVAL):
+                with timed("archive_commit"):
+                    _commit_archive()
+            if archive_state["push_pending"] and now >= archive_state["next_push"]:
+                with timed("archive_push"):
+                    _push_archive()
+        except Exception as e:
+            archive_state["last_error"] = str(e)
+            print(f"Error during GitHub archival: {e}")
+
+
+def start_archiver():
+    with archive_lock:
+        if archive_state["thread"] is None:
+            t = Thread(target=archive_worker, name="archiver", daemon=True)
+            archive_state["thread"] = t
+            t.start()
+    return archive_state["thread"]
+
+
+def archive_to_github(data, normalized=None, flush=False):
+    """Queue a snapshot for archival; writing, committing and pushing happen in the archiver thread."""
+    start_archiver()
+    try:
+        archive_queue.put_nowait((time.time(), data, normalized))
+    except queue.Full:
+        print("Archive: queue full, snapshot dropped.")
+        return False
+    if flush:
+        archive_flush.set()
+    return True
+
+
+def archive_status():
+    return {
+        "queued": archive_queue.qsize(),
+        "pendingSegments": len(archive_state["pending_paths"]),
+        "lastCommit": datetime.fromtimestamp(archive_state["last_commit"], timezone.utc).isoformat(),
+        "pushPending": archive_state["push_pending"],
+        "written": archive_state["written"],
+        "skipped": archive_state["skipped"],
+        "lastError": archive_state["last_error"],
+    }
+
+
+def encode_body(obj):
+    """Serialize ``obj`` once and precompute compressed variants plus a strong ETag."""
+    return encode_bytes(json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=_json_default).encode("utf-8"))
+
+
+def encode_bytes(body):
+    encoded = {"etag": hashlib.sha256(body).hexdigest()[:32], "identity": body, "gzip": gzip.compress(body, 6, mtime=0)}
+    if brotli is not None:
+        encoded["br"] = brotli.compress(body, quality=5)  # the default (11) takes ~1 s per large body
+    return encoded
+
+
+def item_key(item):
+    """Stable identity of a normalized item across snapshots."""
+    if item.get("id"):
+        return f"{item['id']}|{item.get('line') or ''}"
+    return hashlib.sha1(json.dumps(item, sort_keys=True, ensure_ascii=False, default=_json_default).encode("utf-8")).hexdigest()[:16]
+
+
+def assign_item_keys(items):
+    """Set a unique ``key`` on every item; returns {key: item}."""
+    items_by_key = {}
+    for it in items:
+        key = base = item_key(it)
+        n = 1
+        while key in items_by_key:
+            n += 1
+            key = f"{base}#{n}"
+        it["key"] = key
+        items_by_key[key] = it
+    return items_by_key
+
+
+def index_lines(items_by_key):
+    """{network: {code: [item keys]}} for server-side filtering."""
+    index = {}
+    for key, it in items_by_key.items():
+        index.setdefault(it.get("network"), {}).setdefault(it.get("lineCode"), []).append(key)
+    return index
+
+
+def filtered_body(snap, network=None, line=None):
+    """Encoded normalized payload restricted to a network and/or line, memoized per snapshot."""
+    network = network.lower() if network else None
+    code = _line_code(network, line) if line else None
+    memo_key = (network, code)
+    encoded = snap["filtered"].get(memo_key)
+    if encoded is None:
+        nets = [network] if network is not None else list(snap["line_index"])
+        keys = []
+        for net in nets:
+            by_code = snap["line_index"].get(net, {})
+            for c in ([code] if code is not None else by_code):
+                keys.extend(by_code.get(c, ()))
+        items_by_key = snap["items_by_key"]
+        keys = set(keys)
+        normalized = dict(snap["normalized"], items=[it for k, it in items_by_key.items() if k in keys],
+                          filter={"network": network, "line": code})
+        encoded = encode_body(normalized)
+        if keys:  # only memoize filters that match something, so arbitrary query strings cannot grow the memo
+            snap["filtered"][memo_key] = encoded
+    return encoded
+
+
+def build_snapshot(raw, timestamp, version=0):
+    """Normalize and serialize a raw upstream body exactly once; the body itself is served verbatim."""
+    with timed("normalize"):
+        return _build_snapshot(raw, timestamp, version)
+
+
+def _build_snapshot(raw, timestamp, version):
+    normalized = normalize_raw(raw)
+    normalized["version"] = version
+    items_by_key = assign_item_keys(normalized["items"])
+    return {
+        "timestamp": timestamp,
+        "checked": timestamp,
+        "version": version,
+        "raw": raw,
+        "normalized": normalized,
+        "items_by_key": items_by_key,
+        "raw_body": encode_bytes(raw or b"{}"),
+        "normalized_body": encode_body(normalized),
+        "line_index": index_lines(items_by_key),
+        "filtered": {},
+        "deltas": {},
+    }
+
+
+def delta_body(snap, since, network=None, line=None):
+    """Encoded {added, removed, changed} between version ``since`` and ``snap``; None when ``since`` is unknown.
+
+    ``network``/``line`` restrict the delta like filtered_body().
+    """
+    network = network.lower() if network else None
+    code = _line_code(network, line) if line else None
+    memo_key = (since, network, code)
+    encoded = snap["deltas"].get(memo_key)
+    if encoded is None:
+        old = recent_items.get(since)
+        if old is None:
+            return None
+        new = snap["items_by_key"]
+        filtered = network is not None or code is not None
+        if filtered:
+            old = {it["key"]: it for it in filter_items(old.values(), network, code)}
+            new = {it["key"]: it for it in filter_items(new.values(), network, code)}
+        encoded = encode_body({
+            "version": snap["version"],
+            "since": since,
+            "updatedAt": snap["normalized"]["updatedAt"],
+            "added": [it for k, it in new.items() if k not in old],
+            "removed": [k for k in old if k not in new],
+            "changed": [it for k, it in new.items() if k in old and old[k] != it],
+        })
+        # Like filtered_body(), filters matching nothing are not memoized so arbitrary query strings cannot grow it.
+        if since in recent_items and (not filtered or old or new):
+            snap["deltas"][memo_key] = encoded
+    return encoded
+
+
+def send_encoded(encoded, last_modified=None, mimetype="application/json"):
+    """Return a pre-serialized body, picking the best precomputed content encoding."""
+    for coding in ("br", "gzip"):
+        if coding in encoded and request.accept_encodings[coding]:
+            resp = Response(encoded[coding], mimetype=mimetype)
+            resp.headers["Content-Encoding"] = coding
+            resp.set_etag(f"{encoded['etag']}-{coding}")
+            break
+    else:
+        resp = Response(encoded["identity"], mimetype=mimetype)
+        resp.set_etag(encoded["etag"])
+    resp.vary.add("Accept-Encoding")
+    if last_modified:
+        resp.last_modified = datetime.fromtimestamp(last_modified, timezone.utc)
+    return resp.make_conditional(request)
+
+
+def conditional_json(obj, last_modified=None):
+    """jsonify ``obj`` with an ETag (and Last-Modified from epoch ``last_modified``), answering 304 to matching
+    conditional requests."""
+    resp = jsonify(obj)
+    resp.add_etag()
+    if last_modified:
+        resp.last_modified = datetime.fromtimestamp(last_modified, timezone.utc)
+    return resp.make_conditional(request)
+
+
+def refresh_cache():
+    """Fetch a new upstream snapshot and publish it. Returns True when the snapshot was replaced."""
+    global data_cache
+    with cache_lock:
+        started = refresher_state["last_attempt"] = time.time()
+        api_data = get_api_data()
+        if api_data is NOT_MODIFIED and data_cache["raw"] is not None:
+            # Same payload as the current snapshot: only its freshness changes.
+            data_cache = dict(data_cache, checked=time.time())
+            refresher_state["last_error"] = None
+            schedule_next_poll("unchanged", started)
+            publish_state(data_cache)
             try:
-                origin = repo.remote(name='origin')
-                origin.push()
-            except Exception as pe:
-                print(f"Git push skipped/failed: {pe}")
+                with timed("history_index"):
+                    touch_index(data_cache["checked"])
+            except Exception as e:
+                print(f"Warning: failed to index history: {e}")
+            return False
+        if api_data is NOT_MODIFIED or not api_data or api_data.strip() in (b"{}", b"[]"):
+            # Keep serving the last good payload until it reaches the hard TTL.
+            refresher_state["last_error"] = api_diag.get("last_error") or "no data"
+            schedule_next_poll("error", started)
+            publish_state(data_cache)
+            return False
+        try:
+            snap = build_snapshot(api_data, time.time(), data_cache.get("version", 0) + 1)
+        except Exception as e:
+            commit_validators(False)
+            refresher_state["last_error"] = f"could not normalize upstream payload: {e}"
+            schedule_next_poll("error", started)
+            return False
+        refresher_state["last_error"] = None
+        gap = index_gap()  # from the delay that led to this poll, before it is rescheduled
+        schedule_next_poll("changed", started)
+        install_snapshot(snap)
+        commit_validators(True)
+        metric_set("idfm_snapshot_items", len(data_cache["normalized"]["items"]))
+        try:
+            with timed("history_update"):
+                update_history(data_cache["normalized"])
+        except Exception as e:
+            print(f"Warning: failed to update history: {e}")
+        try:
+            with timed("history_index"):
+                index_snapshot(data_cache["normalized"], data_cache["timestamp"], gap=gap)
+        except Exception as e:
+            print(f"Warning: failed to index history: {e}")
+        return True
+
+
+def install_snapshot(snap):
+    """Make ``snap`` the current snapshot in this process and push its delta to /events clients."""
+    global data_cache
+    recent_items[snap["version"]] = snap["items_by_key"]
+    while len(recent_items) > DELTA_HISTORY:
+        recent_items.popitem(last=False)
+    data_cache = snap
+    snapshot_ready.set()
+    publish_snapshot(snap)
+    delta = delta_body(snap, snap["version"] - 1)
+    if delta is not None:
+        broadcast_event(format_event("delta", snap["version"], delta["identity"]))
+
+
+def format_event(event, version, body):
+    """Pre-format one SSE message; ``body`` is compact single-line JSON."""
+    return b"id: %d\nevent: %s\ndata: %s\n\n" % (version, event.encode("ascii"), body)
+
+
+def broadcast_event(message):
+    """Fan ``message`` out to every /events client; clients whose queue is full are dropped."""
+    with sse_lock:
+        clients = list(sse_clients)
+    for q in clients:
+        try:
+            q.put_nowait(message)
+        except queue.Full:
+            with sse_lock:
+                sse_clients.discard(q)
+            q.dropped = True
+
+
+def _quota_floor(now):
+    """Shortest interval that keeps the rest of today's polls within POLL_DAILY_QUOTA."""
+    if POLL_DAILY_QUOTA <= 0:
+        return 0
+    day = datetime.fromtimestamp(now, timezone.utc).date()
+    if day != poll_state["quota_day"]:
+        poll_state.update({"quota_day": day, "calls": 0})
+    reset = datetime.combine(day + timedelta(days=1), datetime.min.time(), timezone.utc).timestamp()
+    remaining = POLL_DAILY_QUOTA - poll_state["calls"]
+    return reset - now if remaining <= 0 else (reset - now) / remaining
+
+
+def schedule_next_poll(outcome, started):
+    """Schedule the next poll from the start of this one; ``outcome`` is "changed", "unchanged" or "error"."""
+    now = time.time()
+    _quota_floor(now)
+    # Discovery probes are not counted: they are rare and backed off separately in get_api_data().
+    poll_state["calls"] += 1
+    if outcome == "error":
+        poll_state["errors"] += 1
+        # Exponential backoff with jitter, so that restarted deployments do not retry in lockstep.
+        delay = min(POLL_ERROR_BACKOFF_MAX, CACHE_DURATION * 2 ** poll_state["errors"])
+        delay = random.uniform(delay / 2, delay)
+    else:
+        poll_state["errors"] = 0
+        changed = outcome == "changed"
+        rate = (1 - POLL_CHANGE_ALPHA) * poll_state["change_rate"] + POLL_CHANGE_ALPHA * changed
+        poll_state["change_rate"] = rate
+        # New data snaps back to the fastest cadence; quiet periods stretch it, more slowly when changes were frequent.
+        if changed:
+            delay = CACHE_DURATION
         else:
-            print("Archive: no changes to commit.")
-    except Exception as e:
-        print(f"Error during GitHub archival: {e}")
+            delay = min(POLL_MAX_INTERVAL, poll_state["interval"] * (1 + POLL_GROWTH * (1 - rate)))
+        poll_state["interval"] = delay
+    delay = max(delay, CACHE_DURATION, _quota_floor(now))
+    poll_state["delay"] = delay
+    # Fixed cadence: time spent fetching and normalizing is part of the interval, not added to it.
+    poll_state["next_run"] = max(started + delay, now)
+    metric_set("idfm_poll_interval_seconds", round(poll_state["interval"], 3))
+    metric_set("idfm_poll_next_run_timestamp", round(poll_state["next_run"], 3))
+    metric_set("idfm_poll_change_rate", round(poll_state["change_rate"], 3))
+    return poll_state["next_run"]
+
+
+def stale_after():
+    """Snapshot age beyond which it is reported stale: two polling intervals, quota floor and backoff included."""
+    return 2 * max(CACHE_DURATION, poll_state["interval"], poll_state["delay"])
+
+
+def index_gap():
+    """Longest absence that still extends an occurrence: polls may be further apart than HISTORY_DB_GAP."""
+    return max(HISTORY_DB_GAP, 2 * poll_state["delay"])
+
+
+def cache_refresher():
+    while True:
+        started = time.time()
+        try:
+            refresh_cache()
+        except Exception as e:
+            refresher_state["last_error"] = str(e)
+            print(f"Warning: cache refresh failed: {e}")
+            schedule_next_poll("error", started)
+        time.sleep(max(0, poll_state["next_run"] - time.time()))
+
+
+def start_refresher():
+    """Start the background refresher that owns all upstream fetches (idempotent)."""
+    with refresher_lock:
+        if refresher_state["thread"] is None:
+            t = Thread(target=cache_refresher, name="cache-refresher", daemon=True)
+            refresher_state["thread"] = t
+            t.start()
+    return refresher_state["thread"]
+
+
+def cache_status():
+    snap = data_cache
+    age = time.time() - snap["checked"] if snap["raw"] is not None else None
+    return {
+        "age": round(age, 1) if age is not None else None,
+        "stale": age is None or age > stale_after() or refresher_state["last_error"] is not None,
+        "expired": age is None or age > CACHE_HARD_TTL,
+        "softTtl": CACHE_DURATION,
+        "hardTtl": CACHE_HARD_TTL,
+        "pollInterval": round(poll_state["interval"], 1),
+        "nextRefresh": datetime.fromtimestamp(poll_state["next_run"], timezone.utc).isoformat() if poll_state["next_run"] else None,
+        "lastError": refresher_state["last_error"],
+    }
+
+
+def get_snapshot():
+    """Return the latest snapshot immediately; only one-shot (CLI) usage fetches inline."""
+    if refresher_state["thread"] is None and serving_state["role"] is None:
+        if time.time() - data_cache.get("checked", 0) > CACHE_DURATION:
+            refresh_cache()
+    elif not snapshot_ready.is_set():
+        snapshot_ready.wait(CACHE_COLD_WAIT)
+    snap = data_cache
+    if snap["raw"] is None or time.time() - snap["checked"] > CACHE_HARD_TTL:
+        metric_inc("idfm_cache_requests_total", {"result": "miss"})
+        return build_snapshot(None, 0)
+    stale = time.time() - snap["checked"] > stale_after()
+    metric_inc("idfm_cache_requests_total", {"result": "stale" if stale else "hit"})
+    return snap
 
 
 def get_ratp_status():
-    with cache_lock:
-        now = time.time()
-        if now - data_cache["timestamp"] > CACHE_DURATION:
-            api_data = get_api_data()
-            if api_data:
-                data_cache["data"] = api_data
-                data_cache["timestamp"] = now
-                try:
-                    update_history(normalize_data(api_data))
-                except Exception as e:
-                    print(f"Warning: failed to update history: {e}")
-        return data_cache["data"]
+    raw = get_snapshot()["raw"]
+    return json.loads(raw) if raw else None
+
+
+# Multi-process serving: one elected poller fetches upstream and publishes every snapshot to a shared file;
+# follower processes map it and serve the pre-encoded bodies without touching PRIM, history or the archive.
+def _shared_state(snap):
+    return {"version": snap["version"], "timestamp": snap["timestamp"], "checked": snap["checked"],
+            "lastError": refresher_state["last_error"], "upstream": {k: api_diag.get(k) for k in API_DIAG_KEYS},
+            "schedule": {"interval": poll_state["interval"], "delay": poll_state["delay"], "nextRun": poll_state["next_run"]}}
+
+
+def publish_state(snap):
+    """Atomically write the small freshness record followers watch (poller only); bodies are not touched."""
+    if serving_state["role"] != "poller" or snap["raw"] is None:
+        return
+    try:
+        tmp = f"{SHARED_STATE_PATH}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(_shared_state(snap), f, separators=(",", ":"))
+        os.replace(tmp, SHARED_STATE_PATH)
+    except Exception as e:
+        print(f"Warning: could not publish snapshot state: {e}")
+    publish_metrics()
+
+
+def publish_snapshot(snap):
+    """Atomically write a new snapshot's encoded bodies to SHARED_SNAPSHOT_PATH, then its state (poller only)."""
+    if serving_state["role"] != "poller" or snap["raw"] is None:
+        return
+    header = dict(_shared_state(snap), etags={}, sections={})
+    blobs = []
+    offset = 0
+    for body in ("raw_body", "normalized_body"):
+        header["etags"][body] = snap[body]["etag"]
+        for coding in ("identity", "gzip", "br"):
+            if coding in snap[body]:
+                blob = snap[body][coding]
+                header["sections"][f"{body}.{coding}"] = [offset, len(blob)]
+                blobs.append(blob)
+                offset += len(blob)
+    head = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    try:
+        tmp = f"{SHARED_SNAPSHOT_PATH}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(len(head).to_bytes(8, "big"))
+            f.write(head)
+            for blob in blobs:
+                f.write(blob)
+        os.replace(tmp, SHARED_SNAPSHOT_PATH)
+    except Exception as e:
+        print(f"Warning: could not publish snapshot: {e}")
+        return
+    publish_state(snap)
+
+
+def load_shared_snapshot():
+    """Map the shared snapshot file; returns (snap, header) or (None, None) when absent."""
+    try:
+        with open(SHARED_SNAPSHOT_PATH, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None, None
+    with mm:
+        head_len = int.from_bytes(mm[:8], "big")
+        header = json.loads(mm[8:8 + head_len])
+        base = 8 + head_len
+        bodies = {"raw_body": {}, "normalized_body": {}}
+        for name, (offset, length) in header["sections"].items():
+            body, coding = name.split(".")
+            bodies[body][coding] = mm[base + offset:base + offset + length]
+    for body, encoded in bodies.items():
+        encoded["etag"] = header["etags"][body]
+    normalized = json.loads(bodies["normalized_body"]["identity"])
+    # Items, not dicts: a follower taking over compares these with the Items of its own next snapshot.
+    normalized["items"] = [Item.from_dict(it) for it in normalized["items"]]
+    snap = {
+        "timestamp": header["timestamp"],
+        "checked": header["checked"],
+        "version": header["version"],
+        "raw": bodies["raw_body"]["identity"],
+        "normalized": normalized,
+        "items_by_key": {it["key"]: it for it in normalized["items"]},
+        "raw_body": bodies["raw_body"],
+        "normalized_body": bodies["normalized_body"],
+        "filtered": {},
+        "deltas": {},
+    }
+    snap["line_index"] = index_lines(snap["items_by_key"])
+    return snap, header
+
+
+def _shared_stamp():
+    try:
+        st = os.stat(SHARED_STATE_PATH)
+        return st.st_mtime_ns, st.st_size, st.st_ino
+    except OSError:
+        return None
+
+
+def _try_become_poller():
+    """Take the poller lock without blocking; True when this process now owns upstream polling."""
+    if fcntl is None:
+        return True
+    os.makedirs(os.path.dirname(POLLER_LOCK_PATH), exist_ok=True)
+    f = open(POLLER_LOCK_PATH, "a")
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return False
+    serving_state["lock_file"] = f
+    return True
+
+
+def _become_poller(archive):
+    global data_cache
+    snap, _ = load_shared_snapshot()
+    if snap is not None and snap["version"] > data_cache.get("version", 0):
+        # Continue the version sequence of the previous poller so that client deltas stay valid.
+        recent_items[snap["version"]] = snap["items_by_key"]
+        data_cache = snap
+        snapshot_ready.set()
+    serving_state["role"] = "poller"
+    start_refresher()
+    if archive:
+        Thread(target=main_loop, args=(True,), name="archive-loop", daemon=True).start()
+
+
+def snapshot_follower(archive):
+    """Follow the poller's shared snapshot; take over polling if the poller goes away."""
+    while True:
+        try:
+            if _try_become_poller():
+                print("Serving: previous poller is gone, taking over upstream polling.")
+                _become_poller(archive)
+                return
+            stamp = _shared_stamp()
+            if stamp is not None and stamp != serving_state["stamp"]:
+                # The state file is tiny and changes on every poll; bodies are only mapped when the version moves.
+                with open(SHARED_STATE_PATH, "r", encoding="utf-8") as f:
+                    state = json.load(f)
+                serving_state["stamp"] = stamp
+                if state["version"] != data_cache.get("version"):
+                    snap, _ = load_shared_snapshot()
+                    if snap is not None and snap["version"] != data_cache.get("version"):
+                        install_snapshot(snap)
+                if state["version"] == data_cache.get("version"):
+                    data_cache.update(checked=state["checked"])
+                refresher_state["last_error"] = state.get("lastError")
+                api_diag.update(state.get("upstream") or {})
+                schedule = state.get("schedule") or {}
+                poll_state.update(interval=schedule.get("interval", CACHE_DURATION), delay=schedule.get("delay", CACHE_DURATION),
+                                  next_run=schedule.get("nextRun"))
+        except Exception as e:
+            print(f"Warning: could not follow shared snapshot: {e}")
+        time.sleep(SHARED_POLL_INTERVAL)
+
+
+def start_serving(archive=False):
+    """Elect this process as poller or follower (idempotent)."""
+    with serving_lock:
+        if serving_state["role"] is not None:
+            return serving_state["role"]
+        try:
+            history_db()  # schema and WAL set up once, before requests come in
+        except Exception as e:
+            print(f"Warning: could not open history index: {e}")
+        if _try_become_poller():
+            _become_poller(archive)
+        else:
+            serving_state["role"] = "follower"
+            Thread(target=snapshot_follower, args=(archive,), name="snapshot-follower", daemon=True).start()
+    return serving_state["role"]
+
+
+def create_app():
+    """WSGI factory for multi-process servers, e.g. gunicorn -w 4 -k gevent 'ratp_status:create_app()'.
+
+    Every /events client holds its connection open, so serve with an async worker (gevent or eventlet) and raise
+    IDFM_SSE_MAX_CLIENTS to the number of dashboards a worker should stream to. With threaded workers
+    (-k gthread --threads 16) each client pins a thread: keep IDFM_SSE_MAX_CLIENTS well below --threads, and the
+    dashboards past it fall back to polling /status_normalized.json?since=.
+    Do not use --preload: the election must happen in each worker after the fork.
+    """
+    start_serving(archive=os.getenv("IDFM_ARCHIVE", "") not in ("", "0"))
+    return app
+
+
+# Dashboard: the page template is compiled once and rendered once per snapshot; CSS and JS are served from
+# content-hashed URLs so browsers cache them indefinitely.
+DASHBOARD_CSS = """\
+:root { --ok:#2e7d32; --warn:#f9a825; --err:#c62828; --bg:#0b1020; --fg:#e5e7eb; --muted:#9aa5b1; --card:#0f1528; --border:#1e293b; }
+body { font-family: system-ui, -apple-system, Segoe UI, Roboto, Ubuntu, Cantarell, 'Helvetica Neue', Arial, 'Noto Sans'; margin: 0; background: var(--bg); color: var(--fg); }
+header { padding: 16px 24px; background:#0a0f1e; border-bottom: 1px solid var(--border); display:flex; align-items:center; justify-content:space-between; position:sticky; top:0; }
+h1 { margin: 0; font-size: 18px; letter-spacing: .3px; }
+.meta { color: var(--muted); font-size: 12px; }
+.container { padding: 16px; }
+.grid { display: grid; grid-template-columns: repeat(auto-fill, minmax(300px, 1fr)); gap: 14px; }
+.card { border: 1px solid var(--border); background:var(--card); border-radius: 10px; padding: 14px; }
+.card-header { display:flex; align-items:center; justify-content:space-between; margin-bottom:6px; }
+.line { font-weight: 700; display:flex; align-items:center; gap:8px; }
+.msg { font-size: 13px; color: var(--fg); }
+.sev { display:inline-block; padding:2px 8px; border-radius: 999px; font-size: 11px; margin-left: 6px; border:1px solid #0003; }
+.sev-BLOQUANTE,.sev-CRITIQUE { background: var(--err); color:#fff; }
+.sev-PERTURBEE,.sev-MAJEURE,.sev-MINEURE { background: var(--warn); color:#111; }
+.sev-NORMALE,.sev-INFO { background: var(--ok); color:#fff; }
+.actions a { color:#60a5fa; text-decoration:none; margin-right: 12px; font-size: 13px; }
+.actions { margin: 8px 0 16px; }
+.empty { color: var(--muted); font-style: italic; padding: 16px; }
+.chip { display:inline-flex; align-items:center; gap:6px; padding:4px 10px; border-radius: 999px; font-weight:700; color:#fff; text-shadow:0 1px 0 #0006; border:1px solid #0004; font-size:13px; }
+.chip small { font-weight:600; opacity:.95; }
+.chip.metro { background:#003CA6; }
+.chip.rer { background:#E2001A; }
+.chip.tram { background:#78BE20; }
+.chip.bus { background:#6C3; color:#111; text-shadow:none; }
+.chip.noir { background:#000; }
+.chip.m1{background:#FFCD00;color:#111;text-shadow:none}
+.chip.m2{background:#003CA6}
+.chip.m3{background:#837902}
+.chip.m4{background:#CF009E}
+.chip.m5{background:#FF7E2E;color:#111;text-shadow:none}
+.chip.m6{background:#6ECA97;color:#111;text-shadow:none}
+.chip.m7{background:#FA9ABA;color:#111;text-shadow:none}
+.chip.m8{background:#D5C900;color:#111;text-shadow:none}
+.chip.m9{background:#B6BD00;color:#111;text-shadow:none}
+.chip.m10{background:#C9910D;color:#111;text-shadow:none}
+.chip.m11{background:#704B1C;color:#fff}
+.chip.m12{background:#007852}
+.chip.m13{background:#6EC4E8;color:#111;text-shadow:none}
+.chip.m14{background:#62259D}
+.chip.ra{background:#ED7D31}
+.chip.rb{background:#3AAA35}
+.chip.rc{background:#FFD200;color:#111;text-shadow:none}
+.chip.rd{background:#E41E25}
+.chip.re{background:#0072BC}
+"""
+
+DASHBOARD_JS = """\
+// Cartes indexées par clé d'item: seules les cartes ajoutées, modifiées ou retirées touchent le DOM
+const state = {version: null, updatedAt: null, items: new Map()};
+const cards = new Map();
+const NET_LABEL = {metro:'M', rer:'RER', tram:'TRAM', bus:'BUS', train:'TRAIN'};
+const sevRank = s => ({'BLOQUANTE':0,'CRITIQUE':1,'MAJEURE':2,'MINEURE':3,'PERTURBEE':4,'INFO':5,'NORMALE':6})[s||'INFO'] ?? 9;
+function sevClass(s){ return s ? ('sev sev-' + s.replace(/\\s+/g,'_')) : 'sev'; }
+function lineBadge(it){ return `<span class="${it.chip||'chip noir'}"><span>${NET_LABEL[it.network]||''}</span><small>${it.lineCode||it.line||''}</small></span>`; }
+function cardHtml(it){
+    const line = it.line || 'Inconnue';
+    const sev = it.severity || '';
+    return `<div class="card-header"><div class="line">${lineBadge(it)}<span class="${sevClass(sev)}">${sev}</span></div>
+        <a style="color:#93c5fd; font-size:12px; text-decoration:none;" href="/history.json?line=${encodeURIComponent(line)}" target="_blank">Historique</a></div>
+        <div class="msg">${it.message || ''}</div>`;
+}
+function upsert(it){
+    let card = cards.get(it.key);
+    if(!card){ card = document.createElement('div'); card.className = 'card'; cards.set(it.key, card); }
+    card.innerHTML = cardHtml(it);
+    state.items.set(it.key, it);
+}
+function remove(key){
+    const card = cards.get(key);
+    if(card){ card.remove(); cards.delete(key); }
+    state.items.delete(key);
+}
+function applyFull(data){
+    const items = (data && data.items) || [];
+    const keep = new Set(items.map(it => it.key));
+    for(const key of Array.from(state.items.keys())) if(!keep.has(key)) remove(key);
+    for(const it of items){
+        const old = state.items.get(it.key);
+        if(!old || JSON.stringify(old) !== JSON.stringify(it)) upsert(it);
+    }
+    state.version = data ? data.version : null;
+    state.updatedAt = data ? data.updatedAt : null;
+    layout();
+}
+function applyDelta(d){
+    for(const k of d.removed) remove(k);
+    for(const it of d.added.concat(d.changed)) upsert(it);
+    state.version = d.version;
+    state.updatedAt = d.updatedAt;
+    layout();
+}
+function layout(){
+    document.getElementById('meta').textContent = state.updatedAt ? ('Maj: ' + state.updatedAt) : '';
+    document.getElementById('empty').style.display = state.items.size ? 'none' : 'block';
+    // Tri simple: BLOQUANTE/CRITIQUE en premier; les cartes existantes sont déplacées, pas reconstruites
+    const grid = document.getElementById('grid');
+    const order = Array.from(state.items.values()).sort((a,b)=> sevRank(a.severity)-sevRank(b.severity));
+    let node = grid.firstChild;
+    for(const it of order){
+        const card = cards.get(it.key);
+        if(card === node){ node = node.nextSibling; continue; }
+        grid.insertBefore(card, node);
+    }
+}
+function poll(){
+    const url = state.version === null ? '/status_normalized.json' : ('/status_normalized.json?since=' + state.version);
+    return fetch(url, {cache:'no-cache'}).then(r=>{
+        if(r.status === 304) return;
+        return r.json().then(data=>{ if(data && data.since !== undefined) applyDelta(data); else applyFull(data); });
+    }).catch(()=>{ document.getElementById('meta').textContent='Erreur de chargement';});
+}
+// Instantané embarqué dans la page: affichage immédiat, puis deltas depuis sa version
+applyFull(JSON.parse(document.getElementById('snapshot').textContent));
+if(window.EventSource){
+    const es = new EventSource('/events?since=' + state.version);
+    es.addEventListener('snapshot', e=>{ applyFull(JSON.parse(e.data)); });
+    es.addEventListener('delta', e=>{
+        const d = JSON.parse(e.data);
+        if(state.version !== d.since){ state.version = null; poll(); return; }
+        applyDelta(d);
+    });
+    es.onerror = ()=>{
+        // Connexion refusée (serveur saturé): EventSource abandonne, on repasse en interrogation périodique
+        if(es.readyState === EventSource.CLOSED){ setInterval(poll, 15000); return; }
+        document.getElementById('meta').textContent='Reconnexion…';
+    };
+} else {
+    setInterval(poll, 15000);
+}
+"""
+
+DASHBOARD_HTML = """<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="utf-8"/>
+    <title>RATP Status</title>
+    <link rel="stylesheet" href="{{ css_url }}"/>
+</head>
+<body>
+    <header>
+        <h1>RATP Status</h1>
+        <div class="meta" id="meta">chargement…</div>
+    </header>
+    <div class="container">
+        <div class="actions">
+            <a href="/status_normalized.json" target="_blank">JSON normalisé</a>
+            <a href="/history.json" target="_blank">Mémoire par ligne</a>
+            <a href="/health" target="_blank">Diagnostics</a>
+        </div>
+        <div id="grid" class="grid"></div>
+        <div id="empty" class="empty" style="display:none">Aucune perturbation active.</div>
+    </div>
+    <script id="snapshot" type="application/json">{{ snapshot|safe }}</script>
+    <script src="{{ js_url }}"></script>
+</body>
+</html>
+"""
+
+
+def _static_asset(name, ext, text, mimetype):
+    encoded = encode_bytes(text.encode("utf-8"))
+    return f"{name}.{encoded['etag'][:12]}.{ext}", {"encoded": encoded, "mimetype": mimetype}
+
+
+DASHBOARD_ASSETS = dict([_static_asset("dashboard", "css", DASHBOARD_CSS, "text/css"),
+                         _static_asset("dashboard", "js", DASHBOARD_JS, "application/javascript")])
+ASSET_MAX_AGE = 365 * 24 * 3600
+dashboard_cache = {"etag": None, "encoded": None}
+
+
+@lru_cache(maxsize=1)
+def dashboard_template():
+    return app.jinja_env.from_string(DASHBOARD_HTML)
+
+
+def render_dashboard(snap):
+    """Encoded dashboard page embedding ``snap``'s normalized body; rendered once per snapshot."""
+    global dashboard_cache
+    cached = dashboard_cache
+    if cached["etag"] == snap["normalized_body"]["etag"]:
+        return cached["encoded"]
+    # "<" is escaped so that message text can never close the embedding <script> element.
+    snapshot = snap["normalized_body"]["identity"].replace(b"<", b"\\u003c").decode("utf-8")
+    urls = {f"{name.split('.')[-1]}_url": f"/assets/{name}" for name in DASHBOARD_ASSETS}
+    html = dashboard_template().render(snapshot=snapshot, **urls)
+    encoded = encode_bytes(html.encode("utf-8"))
+    dashboard_cache = {"etag": snap["normalized_body"]["etag"], "encoded": encoded}
+    return encoded
 
 
 @app.route('/')
 def index():
-    html = """
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <meta charset="utf-8"/>
-        <title>RATP Status</title>
-        <meta http-equiv="refresh" content="30">
-        <style>
-            :root { --ok:#2e7d32; --warn:#f9a825; --err:#c62828; --bg:#0b1020; --fg:#e5e7eb; --muted:#9aa5b1; --card:#0f1528; --border:#1e293b; }
-            body { font-family: system-ui, -apple-system, Segoe UI, Roboto, Ubuntu, Cantarell, 'Helvetica Neue', Arial, 'Noto Sans'; margin: 0; background: var(--bg); color: var(--fg); }
-            header { padding: 16px 24px; background:#0a0f1e; border-bottom: 1px solid var(--border); display:flex; align-items:center; justify-content:space-between; position:sticky; top:0; }
-            h1 { margin: 0; font-size: 18px; letter-spacing: .3px; }
-            .meta { color: var(--muted); font-size: 12px; }
-            .container { padding: 16px; }
-            .grid { display: grid; grid-template-columns: repeat(auto-fill, minmax(300px, 1fr)); gap: 14px; }
-            .card { border: 1px solid var(--border); background:var(--card); border-radius: 10px; padding: 14px; }
-            .card-header { display:flex; align-items:center; justify-content:space-between; margin-bottom:6px; }
-            .line { font-weight: 700; display:flex; align-items:center; gap:8px; }
-            .msg { font-size: 13px; color: var(--fg); }
-            .sev { display:inline-block; padding:2px 8px; border-radius: 999px; font-size: 11px; margin-left: 6px; border:1px solid #0003; }
-            .sev-BLOQUANTE,.sev-CRITIQUE { background: var(--err); color:#fff; }
-            .sev-PERTURBEE,.sev-MAJEURE,.sev-MINEURE { background: var(--warn); color:#111; }
-            .sev-NORMALE,.sev-INFO { background: var(--ok); color:#fff; }
-            .actions a { color:#60a5fa; text-decoration:none; margin-right: 12px; font-size: 13px; }
-            .actions { margin: 8px 0 16px; }
-            .empty { color: var(--muted); font-style: italic; padding: 16px; }
-            .chip { display:inline-flex; align-items:center; gap:6px; padding:4px 10px; border-radius: 999px; font-weight:700; color:#fff; text-shadow:0 1px 0 #0006; border:1px solid #0004; font-size:13px; }
-            .chip small { font-weight:600; opacity:.95; }
-            .chip.metro { background:#003CA6; }
-            .chip.rer { background:#E2001A; }
-            .chip.tram { background:#78BE20; }
-            .chip.bus { background:#6C3; color:#111; text-shadow:none; }
-            .chip.noir { background:#000; }
-            .chip.m1{background:#FFCD00;color:#111;text-shadow:none}
-            .chip.m2{background:#003CA6}
-            .chip.m3{background:#837902}
-            .chip.m4{background:#CF009E}
-            .chip.m5{background:#FF7E2E;color:#111;text-shadow:none}
-            .chip.m6{background:#6ECA97;color:#111;text-shadow:none}
-            .chip.m7{background:#FA9ABA;color:#111;text-shadow:none}
-            .chip.m8{background:#D5C900;color:#111;text-shadow:none}
-            .chip.m9{background:#B6BD00;color:#111;text-shadow:none}
-            .chip.m10{background:#C9910D;color:#111;text-shadow:none}
-            .chip.m11{background:#704B1C;color:#fff}
-            .chip.m12{background:#007852}
-            .chip.m13{background:#6EC4E8;color:#111;text-shadow:none}
-            .chip.m14{background:#62259D}
-            .chip.ra{background:#ED7D31}
-            .chip.rb{background:#3AAA35}
-            .chip.rc{background:#FFD200;color:#111;text-shadow:none}
-            .chip.rd{background:#E41E25}
-            .chip.re{background:#0072BC}
-        </style>
-    </head>
-    <body>
-        <header>
-            <h1>RATP Status</h1>
-            <div class="meta" id="meta">chargement…</div>
-        </header>
-        <div class="container">
-            <div class="actions">
-                <a href="/status_normalized.json" target="_blank">JSON normalisé</a>
-                <a href="/history.json" target="_blank">Mémoire par ligne</a>
-                <a href="/health" target="_blank">Diagnostics</a>
-            </div>
-            <div id="grid" class="grid"></div>
-            <div id="empty" class="empty" style="display:none">Aucune perturbation active.</div>
-        </div>
-        <script>
-            function sevClass(s){ return s ? ('sev sev-' + s.replace(/\\s+/g,'_')) : 'sev'; }
-            function lineToken(s){ if(!s) return {code:'',net:'',cls:''};
-                const t = String(s).toUpperCase();
-                const m = t.match(/(METRO|M)\s*(\d{1,2})/);
-                if(m) return {code:m[2], net:'M', cls:('chip metro m'+m[2])};
-                const r = t.match(/RER\s*([A-E])/);
-                if(r) return {code:r[1], net:'RER', cls:('chip rer r'+r[1].toLowerCase())};
-                const tr = t.match(/T(RAM)?\s*(\d{1,2})/);
-                if(tr) return {code:('T'+tr[2]), net:'TRAM', cls:'chip tram'};
-                const b = t.match(/BUS\s*(\d+)/);
-                if(b) return {code:b[1], net:'BUS', cls:'chip bus'};
-                return {code:t, net:'', cls:'chip noir'};
-            }
-            function lineBadge(name){ const tk=lineToken(name); return `<span class="${tk.cls}"><span>${tk.net||''}</span><small>${tk.code||name||''}</small></span>`; }
-            function render(data){
-                const grid = document.getElementById('grid');
-                const empty = document.getElementById('empty');
-                const meta = document.getElementById('meta');
-                grid.innerHTML='';
-                let items = (data && data.items) || [];
-                meta.textContent = (data && data.updatedAt) ? ('Maj: ' + data.updatedAt) : '';
-                if(!items.length){ empty.style.display='block'; return; }
-                empty.style.display='none';
-                // Afficher une carte par perturbation pour éviter la fusion en une seule ligne "Inconnue"
-                // Tri simple: BLOQUANTE/CRITIQUE en premier
-                const sevRank = s => ({'BLOQUANTE':0,'CRITIQUE':1,'MAJEURE':2,'MINEURE':3,'PERTURBEE':4,'INFO':5,'NORMALE':6})[s||'INFO'] ?? 9;
-                items = items.slice().sort((a,b)=> sevRank(a.severity)-sevRank(b.severity));
-                for(const it of items){
-                    const line = it.line || 'Inconnue';
-                    const sev = it.severity || '';
-                    const msg = it.message || '';
-                    const card = document.createElement('div');
-                    card.className='card';
-                    card.innerHTML = `<div class="card-header"><div class="line">${lineBadge(line)}<span class="${sevClass(sev)}">${sev || ''}</span></div>
-                        <a style="color:#93c5fd; font-size:12px; text-decoration:none;" href="/history.json#${encodeURIComponent(line)}" target="_blank">Historique</a></div>
-                        <div class="msg">${msg}</div>`;
-                    grid.appendChild(card);
-                }
-            }
-            fetch('/status_normalized.json').then(r=>r.json()).then(render).catch(()=>{ document.getElementById('meta').textContent='Erreur de chargement';});
-        </script>
-    </body>
-    </html>
-    """
-    return render_template_string(html)
+    snap = get_snapshot()
+    resp = send_encoded(render_dashboard(snap), snap["timestamp"], mimetype="text/html")
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+
+@app.route('/assets/<name>')
+def asset(name):
+    entry = DASHBOARD_ASSETS.get(name)
+    if entry is None:
+        return Response("Not found", status=404, mimetype="text/plain")
+    resp = send_encoded(entry["encoded"], mimetype=entry["mimetype"])
+    resp.headers["Cache-Control"] = f"public, max-age={ASSET_MAX_AGE}, immutable"
+    return resp
 
 
 @app.route('/status.json')
 def status_json():
-    return jsonify(get_ratp_status() or {})
+    snap = get_snapshot()
+    return send_encoded(snap["raw_body"], snap["timestamp"])
 
 
 @app.route('/status_normalized.json')
 def status_normalized_json():
-    return jsonify(normalize_data(get_ratp_status()))
+    snap = get_snapshot()
+    network = request.args.get("network") or None
+    line = request.args.get("line") or None
+    since = request.args.get("since", type=int)
+    if since is not None:
+        encoded = delta_body(snap, since, network, line)
+        if encoded is not None:
+            return send_encoded(encoded, snap["timestamp"])
+    if network or line:
+        return send_encoded(filtered_body(snap, network, line), snap["timestamp"])
+    return send_encoded(snap["normalized_body"], snap["timestamp"])
 
 
 @app.route('/health')
 def health():
-    data = get_ratp_status()
-    norm = normalize_data(data)
-    return jsonify({"ok": bool(norm.get("items")), "items_count": len(norm.get("items", [])), "meta": norm.get("meta")})
+    snap = get_snapshot()
+    norm = snap["normalized"]
+    return conditional_json({"ok": bool(norm.get("items")), "items_count": len(norm.get("items", [])), "meta": norm.get("meta"), "cache": cache_status(),
+                             "upstream": {k: api_diag.get(k) for k in API_DIAG_KEYS},
+                             "archive": archive_status()}, snap["checked"])
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(resp):
+    started = getattr(g, "request_started", None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        metric_observe("idfm_http_request_seconds", time.perf_counter() - started, {"route": route, "status": str(resp.status_code)})
+        if resp.content_length is not None:
+            metric_observe("idfm_http_response_bytes", resp.content_length, {"route": route}, buckets=SIZE_BUCKETS)
+    return resp
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    snap = data_cache
+    if snap["raw"] is not None:
+        metric_set("idfm_cache_age_seconds", round(time.time() - snap["checked"], 3))
+        metric_set("idfm_snapshot_version", snap["version"])
+    if serving_state["role"] != "follower":
+        metric_set("idfm_archive_queue", archive_queue.qsize())
+    metric_set("idfm_sse_clients", len(sse_clients))
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+
+@app.after_request
+def add_cache_headers(resp):
+    status = cache_status()
+    if status["age"] is not None:
+        resp.headers["X-Cache-Age"] = str(int(status["age"]))
+    resp.headers["X-Cache-Stale"] = "1" if status["stale"] else "0"
+    return resp
+
+
+@app.route('/events')
+def events():
+    """Server-Sent Events: a full snapshot (or a delta from Last-Event-ID / ?since=) then one delta per new snapshot."""
+    snap = get_snapshot()
+    last_id = request.headers.get("Last-Event-ID", type=int)
+    if last_id is None:
+        last_id = request.args.get("since", type=int)
+    delta = delta_body(snap, last_id) if last_id is not None else None
+    if delta is not None:
+        first = format_event("delta", snap["version"], delta["identity"])
+    else:
+        first = format_event("snapshot", snap["version"], snap["normalized_body"]["identity"])
+    q = queue.Queue(maxsize=SSE_QUEUE_SIZE)
+    q.dropped = False
+    with sse_lock:
+        full = len(sse_clients) >= SSE_MAX_CLIENTS
+        if not full:
+            sse_clients.add(q)
+    if full:
+        # EventSource gives up on a non-200 answer; the dashboard then polls ?since= instead.
+        resp = Response("Trop de connexions /events, utilisez /status_normalized.json?since=", status=503, mimetype="text/plain")
+        resp.headers["Retry-After"] = str(SSE_HEARTBEAT)
+        return resp
+
+    def stream():
+        try:
+            yield b"retry: 5000\n\n" + first
+            while not q.dropped:
+                try:
+                    yield q.get(timeout=SSE_HEARTBEAT)
+                except queue.Empty:
+                    yield b": ping\n\n"
+        finally:
+            with sse_lock:
+                sse_clients.discard(q)
+
+    resp = Response(stream(), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
 
 
 @app.route('/history.json')
 def history_json():
-    return jsonify(load_history())
+    line = request.args.get("line")
+    if line:
+        return conditional_json({"line": line, "entries": history_for_line(line)}, history_updated())
+    return send_encoded(history_body(), history_updated())
+
+
+def _index_updated():
+    # The poller indexes every snapshot it checks, so the index is as recent as the snapshot's last check.
+    return data_cache["checked"] if data_cache["raw"] is not None else None
+
+
+def _history_query_args():
+    args = request.args
+    return {
+        "line": args.get("line") or None,
+        "start": parse_time_arg(args.get("from")),
+        "end": parse_time_arg(args.get("to")),
+        "severity": args.get("severity") or None,
+        "cause": args.get("cause") or None,
+    }
+
+
+@app.route('/history/query')
+def history_query():
+    try:
+        filters = _history_query_args()
+        limit = min(max(request.args.get("limit", 100, type=int), 1), HISTORY_QUERY_MAX)
+        offset = max(request.args.get("offset", 0, type=int), 0)
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    result = query_history(limit=limit, offset=offset, **filters)
+    if offset + limit < result["total"]:
+        result["nextOffset"] = offset + limit
+    return conditional_json(result, _index_updated())
+
+
+@app.route('/history/aggregate')
+def history_aggregate():
+    try:
+        filters = _history_query_args()
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    return conditional_json({"rows": aggregate_history(**filters)}, _index_updated())
+
+
+@app.route('/archive/snapshot')
+def archive_snapshot():
+    """Archived upstream payload in effect at ?at= (epoch or ISO 8601)."""
+    try:
+        when = parse_time_arg(request.args.get("at"))
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    found = archive_snapshot_at(when if when is not None else time.time())
+    if found is None:
+        return jsonify({"ok": False, "error": "no archived snapshot at or before this time"}), 404
+    ts, data = found
+    return conditional_json({"ts": datetime.fromtimestamp(ts, timezone.utc).isoformat(), "data": data})
 
 
 @app.route('/admin/force-archive')
 def admin_force_archive():
-    data = get_ratp_status()
-    if not data:
+    if serving_state["role"] == "follower":
+        # Only the poller writes and commits the archive; a second archiver would race it on the git index.
+        return jsonify({"ok": False, "error": "archiving runs in the poller process, retry the request"}), 409
+    snap = get_snapshot()
+    if not snap["raw"]:
         return jsonify({"ok": False, "error": "no data"}), 503
     try:
-        archive_to_github(data)
-        return jsonify({"ok": True})
+        queued = archive_to_github(snap["raw"], snap["normalized"], flush=True)
+        return jsonify({"ok": queued, "archive": archive_status()})
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
 
 
+def archive_days(date_from=None, date_to=None):
+    """Sorted data/<YYYY-MM-DD> directory names within [date_from, date_to]."""
+    root = os.path.join(REPO_PATH, "data")
+    if not os.path.isdir(root):
+        return []
+    return sorted(d for d in os.listdir(root)
+                  if re.fullmatch(r"\d{4}-\d{2}-\d{2}", d) and os.path.isdir(os.path.join(root, d))
+                  and (not date_from or d >= date_from) and (not date_to or d <= date_to))
+
+
+def _legacy_snapshot_ts(name: str):
+    """Epoch of a pre-segment archive file named YYYY-MM-DD_HH-MM[-SSs[-NN]].json (local time)."""
+    m = re.match(r"(\d{4}-\d{2}-\d{2}_\d{2}-\d{2})(?:-(\d{2})s)?", name)
+    if not m:
+        return None
+    return datetime.strptime(m.group(1), "%Y-%m-%d_%H-%M").timestamp() + int(m.group(2) or 0)
+
+
+def iter_day_snapshots(day: str, packed=True, sources=None, errors=None):
+    """Yield (epoch, payload) for every archived snapshot of ``day``, whatever its storage, one file at a time.
+
+    Snapshots come in file order, not time order. The files read (legacy .normalized.json companions included)
+    are appended to ``sources`` and the files that could not be read to ``errors``, when given.
+    """
+    day_dir = os.path.join(REPO_PATH, "data", day)
+    for name in sorted(os.listdir(day_dir)):
+        path = os.path.join(day_dir, name)
+        try:
+            if name == "snapshots.pack":
+                if not packed:
+                    continue
+                for ts, data in iter_pack_snapshots(path):
+                    yield datetime.fromisoformat(ts).timestamp(), data
+            elif name.startswith("snapshots.jsonl"):
+                for ts, data in iter_archive_snapshots(path):
+                    yield datetime.fromisoformat(ts).timestamp(), data
+            elif name.endswith(".normalized.json"):
+                pass
+            elif name.endswith(".json"):
+                ts = _legacy_snapshot_ts(name)
+                if ts is None:
+                    continue
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                yield ts, data
+            else:
+                continue
+            if sources is not None:
+                sources.append(path)
+        except Exception as e:
+            print(f"Warning: skipping archive file {path}: {e}")
+            if errors is not None:
+                errors.append(path)
+
+
+def _day_snapshots(day: str, packed=True):
+    """Every archived snapshot of ``day`` as sorted [(epoch, payload)], with the files read and those skipped."""
+    sources = []
+    errors = []
+    snapshots = sorted(iter_day_snapshots(day, packed, sources, errors), key=lambda s: s[0])
+    return snapshots, sources, errors
+
+
+def _reindex_day(day: str):
+    """Worker: normalize every archived snapshot of ``day``; returns [(epoch, normalized)] sorted by time.
+
+    Payloads are normalized as they are read, so a legacy day of per-cycle files is never held decoded at once.
+    """
+    results = []
+    for ts, data in iter_day_snapshots(day):
+        norm = normalize_data(data)
+        norm["updatedAt"] = datetime.fromtimestamp(ts, timezone.utc).isoformat()
+        norm.pop("meta", None)
+        assign_item_keys(norm["items"])
+        results.append((ts, norm))
+    results.sort(key=lambda r: r[0])
+    return results
+
+
+def reindex(date_from=None, date_to=None, workers=None):
+    """Rebuild history and the history index from archived snapshots, resuming an interrupted run.
+
+    The server must not be running: a poller would overwrite the rebuilt history with its in-memory copy, so
+    reindex holds the poller lock for its whole run and refuses to start while another process owns it.
+    """
+    days = archive_days(date_from, date_to)
+    if not days:
+        print("Reindex: no archived days in range.")
+        return
+    if serving_state["lock_file"] is None and not _try_become_poller():
+        print(f"Warning: {POLLER_LOCK_PATH} is held by a running server; stop it before reindexing.")
+        return
+    checkpoint = None
+    try:
+        with open(REINDEX_CHECKPOINT_PATH, "r", encoding="utf-8") as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        pass
+    if checkpoint and checkpoint.get("from") == date_from and checkpoint.get("to") == date_to:
+        days = [d for d in days if d > checkpoint["done"]]
+        print(f"Reindex: resuming after {checkpoint['done']}")
+    else:
+        # Fresh run: drop occurrences that start inside the range, they are rebuilt below.
+        lo = datetime.strptime(days[0], "%Y-%m-%d").timestamp()
+        hi = datetime.strptime(days[-1], "%Y-%m-%d").timestamp() + 86400
+        with index_lock:
+            with history_db() as conn:
+                conn.execute("DELETE FROM occurrences WHERE first_seen >= ? AND first_seen < ?", (lo, hi))
+            index_state["open"] = None
+
+    started = time.time()
+    snapshots = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # One day in flight per worker; results are merged strictly in day order.
+        window = workers or os.cpu_count() or 1
+        todo = iter(days)
+        pending = deque((d, pool.submit(_reindex_day, d)) for d, _ in zip(todo, range(window)))
+        for done, _ in enumerate(days, 1):
+            day, fut = pending.popleft()
+            nxt = next(todo, None)
+            if nxt is not None:
+                pending.append((nxt, pool.submit(_reindex_day, nxt)))
+            results = fut.result()
+            day_start = datetime.strptime(day, "%Y-%m-%d")
+            replace_history_range(results, day_start.timestamp(), (day_start + timedelta(days=1)).timestamp())
+            with history_lock:
+                compact_history()
+            for ts, norm in results:
+                index_snapshot(norm, ts, gap=REINDEX_GAP)
+            snapshots += len(results)
+            with open(REINDEX_CHECKPOINT_PATH, "w", encoding="utf-8") as f:
+                json.dump({"from": date_from, "to": date_to, "done": day}, f)
+            print(f"Reindex: {day} {len(results)} snapshot(s) [{done}/{len(days)}] {time.time() - started:.1f}s")
+    os.remove(REINDEX_CHECKPOINT_PATH)
+    print(f"Reindex: {snapshots} snapshot(s) from {len(days)} day(s) in {time.time() - started:.1f}s")
+
+
+def sample_snapshots(snapshots, interval):
+    """Keep the first snapshot of every ``interval``-second bucket."""
+    kept = []
+    last = None
+    for ts, data in snapshots:
+        bucket = int(ts // interval)
+        if bucket != last:
+            kept.append((ts, data))
+            last = bucket
+    return kept
+
+
+def pack_archive_day(day: str, resolution=0):
+    """Rewrite every snapshot of a closed ``day`` into its pack, sampled every ``resolution`` seconds when set.
+
+    The segment and legacy files are removed once packed. Returns the number of snapshots kept, or None when
+    some file could not be read (the day is then left untouched).
+    """
+    snapshots, sources, errors = _day_snapshots(day)
+    if errors:
+        return None
+    if resolution:
+        snapshots = sample_snapshots(snapshots, resolution)
+    path = archive_pack_path(day)
+    if snapshots:
+        write_archive_pack(path, snapshots, resolution)
+    day_dir = os.path.dirname(path)
+    for name in os.listdir(day_dir):
+        src = os.path.join(day_dir, name)
+        if (src in sources or name.endswith(".normalized.json")) and (src != path or not snapshots):
+            os.remove(src)
+    return len(snapshots)
+
+
+def _day_snapshot_at(day: str, when: float):
+    """Last snapshot of ``day`` at or before ``when``: a seek into the pack, a scan of the segments up to ``when``
+    and, among legacy files, only the latest one before ``when`` is decoded."""
+    found = []
+    legacy = None
+    day_dir = os.path.join(REPO_PATH, "data", day)
+    for name in sorted(os.listdir(day_dir)):
+        path = os.path.join(day_dir, name)
+        try:
+            if name == "snapshots.pack":
+                hit = pack_snapshot_at(path, when)
+            elif name.startswith("snapshots.jsonl"):
+                hit = segment_snapshot_at(path, when)
+            else:
+                ts = _legacy_snapshot_ts(name) if name.endswith(".json") and not name.endswith(".normalized.json") else None
+                if ts is not None and ts <= when and (legacy is None or ts > legacy[0]):
+                    legacy = (ts, path)
+                continue
+            if hit is not None:
+                found.append((datetime.fromisoformat(hit[0]).timestamp(), hit[1]))
+        except Exception as e:
+            print(f"Warning: skipping archive file {path}: {e}")
+    if legacy is not None:
+        try:
+            with open(legacy[1], "r", encoding="utf-8") as f:
+                found.append((legacy[0], json.load(f)))
+        except Exception as e:
+            print(f"Warning: skipping archive file {legacy[1]}: {e}")
+    return max(found, key=lambda s: s[0]) if found else None
+
+
+def archive_snapshot_at(when: float):
+    """(epoch, payload) of the archived snapshot in effect at epoch ``when``, or None when nothing is archived before it."""
+    for day in reversed(archive_days(date_to=datetime.fromtimestamp(when).strftime("%Y-%m-%d"))):
+        found = _day_snapshot_at(day, when)
+        if found is not None:
+            return found
+    return None
+
+
+def maintain_archive(date_from=None, date_to=None):
+    """Pack closed days, sample days older than ARCHIVE_FULL_DAYS and drop days older than ARCHIVE_MAX_DAYS.
+
+    Progress is kept in ARCHIVE_MAINTENANCE_PATH so that each run only visits the days that crossed a boundary
+    since the previous one; an explicit --from/--to range revisits its days regardless.
+    """
+    cursor = {"packed": "", "sampled": "", "expired": ""}
+    try:
+        with open(ARCHIVE_MAINTENANCE_PATH, "r", encoding="utf-8") as f:
+            cursor.update(json.load(f))
+    except (OSError, ValueError):
+        pass
+    now = datetime.now()
+    # A snapshot fetched just before midnight may still be written shortly after it.
+    closed = (now - timedelta(hours=1)).strftime("%Y-%m-%d")
+    full = (now - timedelta(days=ARCHIVE_FULL_DAYS)).strftime("%Y-%m-%d")
+    expire = (now - timedelta(days=ARCHIVE_MAX_DAYS)).strftime("%Y-%m-%d") if ARCHIVE_MAX_DAYS > 0 else ""
+    revisit = bool(date_from or date_to)
+    started = time.time()
+    done = {"packed": 0, "sampled": 0, "expired": 0}
+    repo = None
+    pending = {os.path.dirname(os.path.abspath(p)) for p in archive_state["pending_paths"]}
+    try:
+        repo = ensure_git_repo(REPO_PATH)
+        # Segments the live archiver (usually another process) has written but not committed yet.
+        for entry in repo.git.status("--porcelain", "--untracked-files=all", "--", "data").splitlines():
+            path = os.path.join(repo.working_tree_dir, entry[3:].strip('"'))
+            if os.path.basename(path).startswith("snapshots.jsonl"):
+                pending.add(os.path.dirname(path))
+    except Exception as e:
+        print(f"Warning: could not list uncommitted archive segments: {e}")
+    changed = []
+    failed = False
+    for day in archive_days(date_from, date_to):
+        if day >= closed:
+            break
+        day_dir = os.path.join(REPO_PATH, "data", day)
+        if day < expire:
+            if revisit or day > cursor["expired"]:
+                shutil.rmtree(day_dir)
+                changed.append(day_dir)
+                done["expired"] += 1
+            if not failed:
+                cursor["expired"] = max(cursor["expired"], day)
+            continue
+        resolution = ARCHIVE_SAMPLE_INTERVAL if day < full else 0
+        needs_pack = revisit or day > cursor["packed"]
+        needs_sample = bool(resolution) and (revisit or day > cursor["sampled"])
+        if needs_sample and not needs_pack and os.path.exists(archive_pack_path(day)):
+            needs_sample = read_pack_index(archive_pack_path(day)).get("resolution", 0) < resolution
+        if (needs_pack or needs_sample) and os.path.abspath(day_dir) in pending:
+            print(f"Maintenance: {day} left as is, its segment is not committed yet.")
+            failed = True
+            continue
+        if needs_pack or needs_sample:
+            kept = pack_archive_day(day, resolution)
+            if kept is None:
+                print(f"Maintenance: {day} left as is, some files could not be read.")
+                failed = True
+                continue
+            changed.append(day_dir)
+            done["sampled" if needs_sample else "packed"] += 1
+            print(f"Maintenance: {day} packed, {kept} snapshot(s)" + (f" sampled every {resolution}s" if resolution else ""))
+        if not failed:
+            # Stop advancing at the first failure so that the next run retries that day.
+            cursor["packed"] = max(cursor["packed"], day)
+            if resolution:
+                cursor["sampled"] = max(cursor["sampled"], day)
+    if not revisit:
+        with open(ARCHIVE_MAINTENANCE_PATH, "w", encoding="utf-8") as f:
+            json.dump(cursor, f)
+    if changed:
+        try:
+            repo = repo or ensure_git_repo(REPO_PATH)
+            for path in changed:
+                repo.git.rm("-r", "-q", "--cached", "--ignore-unmatch", "--", path)
+                if os.path.exists(path):
+                    repo.git.add("--", path)
+            if repo.is_dirty(index=True, working_tree=False):
+                repo.index.commit(f"Archive maintenance: {done['packed']} packed, {done['sampled']} sampled, {done['expired']} expired",
+                                  author=Actor("RATP Status Bot", "bot@example.com"),
+                                  committer=Actor("RATP Status Bot", "bot@example.com"))
+        except Exception as e:
+            print(f"Warning: could not commit archive maintenance: {e}")
+    print(f"Maintenance: {done['packed']} packed, {done['sampled']} sampled, {done['expired']} expired in {time.time() - started:.1f}s")
+    return done
+
+
 def main_loop(archive=False):
+    archived_version = None
     while True:
-        data = get_ratp_status()
-        if data and archive:
-            archive_to_github(data)
-        time.sleep(CACHE_DURATION)
+        snap = get_snapshot()
+        if snap["raw"] and archive and snap["version"] != archived_version:
+            archive_to_github(snap["raw"], snap["normalized"])
+            archived_version = snap["version"]
+        # Wake up just after the next scheduled poll rather than on a fixed period.
+        next_run = poll_state["next_run"]
+        time.sleep(max(1.0, next_run - time.time() + 1.0) if next_run else CACHE_DURATION)
 
 
 def display_in_console(data, network=None, line=None):
     norm = normalize_data(data)
-    items = norm.get("items", [])
+    items = filter_items(norm.get("items", []), network, line)
     print(f"Mise à jour: {norm.get('updatedAt')}")
     if not items:
         print("Aucune perturbation active.")
@@ -491,6 +2726,12 @@ if __name__ == "__main__":
     parser.add_argument("--line", type=str, help="Filter by line (e.g., '1').")
     parser.add_argument("--api-key", type=str, help="Override API key (or set IDFM_API_KEY env var).")
     parser.add_argument("--api-url", type=str, help="Override API base URL (or set IDFM_API_URL env var).")
+    parser.add_argument("--reindex", action="store_true", help="Rebuild history from archived snapshots under data/.")
+    parser.add_argument("--maintain", action="store_true",
+                        help="Pack closed archive days and apply retention (run daily, e.g. from cron).")
+    parser.add_argument("--from", dest="date_from", type=str, help="First day to reindex or maintain (YYYY-MM-DD).")
+    parser.add_argument("--to", dest="date_to", type=str, help="Last day to reindex or maintain (YYYY-MM-DD).")
+    parser.add_argument("--workers", type=int, help="Worker processes for --reindex (default: CPU count).")
 
     args = parser.parse_args()
 
@@ -500,9 +2741,12 @@ if __name__ == "__main__":
         API_URL_BASE = args.api_url
         API_URL_CANDIDATES = _build_api_url_candidates(API_URL_BASE)
 
-    if args.server:
-        if args.archive:
-            Thread(target=main_loop, args=(True,), daemon=True).start()
+    if args.reindex:
+        reindex(args.date_from, args.date_to, args.workers)
+    elif args.maintain:
+        maintain_archive(args.date_from, args.date_to)
+    elif args.server:
+        start_serving(archive=args.archive)
         app.run(host='0.0.0.0', port=3000)
     else:
         data = get_ratp_status()